@@ -0,0 +1,158 @@
+# admission.py
+
+# Контроль допуска HTTP-запросов: не больше ADMISSION_CONCURRENCY запросов в обработке,
+# остальные ждут в очереди по приоритету - действия с дверью, затем чтение статусов,
+# затем страницы. Если места в очереди нет или время ожидания класса истекло,
+# запрос сразу получает 503 с Retry-After вместо того, чтобы висеть.
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+
+from fastapi import APIRouter
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+DOOR, STATUS, UI = 0, 1, 2
+CLASS_NAMES = {DOOR: "door", STATUS: "status", UI: "ui"}
+
+DOOR_ACTIONS = ("/open-door-key", "/call", "/stop-call", "/provision", "/keys/revoke")
+STATUS_READS = ("/status", "/call-status", "/call-status-update")
+STATUS_PREFIXES = ("/debug/", "/journal", "/fleet/")
+
+
+def classify(method: str, path: str) -> int | None:
+    # None - запрос не ограничивается (статика отдаётся из памяти)
+    if path.startswith("/static/"):
+        return None
+    if method == "POST" and path.endswith(DOOR_ACTIONS):
+        return DOOR
+    if path.startswith(STATUS_PREFIXES) or path.endswith(STATUS_READS):
+        return STATUS
+    return UI
+
+
+class AdmissionController:
+    def __init__(self, limit: int, queue_size: int, queue_timeouts: dict):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeouts = queue_timeouts
+        self.active = 0
+        self.waiters = []  # куча (приоритет, порядок, future)
+        self.order = itertools.count()
+        self.stats = {name: {"admitted": 0, "queued": 0, "shed_queue_full": 0, "shed_timeout": 0}
+                      for name in CLASS_NAMES.values()}
+
+    def _queued(self) -> int:
+        return sum(1 for _, _, waiter in self.waiters if not waiter.done())
+
+    def _shed_lowest(self, priority: int) -> bool:
+        # Освобождаем место в очереди, вытесняя самый низкоприоритетный запрос, если он ниже нового
+        live = [entry for entry in self.waiters if not entry[2].done()]
+        if not live:
+            return False
+        lowest = max(live, key=lambda entry: (entry[0], -entry[1]))
+        if lowest[0] <= priority:
+            return False
+        lowest[2].set_result(False)
+        self.stats[CLASS_NAMES[lowest[0]]]["shed_queue_full"] += 1
+        return True
+
+    async def acquire(self, priority: int) -> bool:
+        stats = self.stats[CLASS_NAMES[priority]]
+        if self.active < self.limit and not self._queued():
+            self.active += 1
+            stats["admitted"] += 1
+            return True
+        if self._queued() >= self.queue_size and not self._shed_lowest(priority):
+            stats["shed_queue_full"] += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), waiter))
+        stats["queued"] += 1
+        try:
+            admitted = await asyncio.wait_for(waiter, self.queue_timeouts[priority])
+        except asyncio.TimeoutError:
+            # Место могло быть передано одновременно с истечением времени - тогда оно уже наше
+            admitted = waiter.done() and not waiter.cancelled() and waiter.result()
+            if not admitted:
+                stats["shed_timeout"] += 1
+                return False
+        if admitted:
+            stats["admitted"] += 1
+        return admitted
+
+    def release(self):
+        # Место передаётся следующему ожидающему напрямую, счётчик active не меняется
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.active -= 1
+
+    def snapshot(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "queued": self._queued(), "classes": self.stats}
+
+
+controller = AdmissionController(settings.ADMISSION_CONCURRENCY, settings.ADMISSION_QUEUE_SIZE,
+                                 {DOOR: settings.ADMISSION_QUEUE_TIMEOUT_DOOR,
+                                  STATUS: settings.ADMISSION_QUEUE_TIMEOUT_STATUS,
+                                  UI: settings.ADMISSION_QUEUE_TIMEOUT_UI})
+
+
+async def send_overloaded(send):
+    body = json.dumps({"detail": "Сервер перегружен, повторите запрос позже"}).encode()
+    await send({"type": "http.response.start",
+                "status": 503,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()),
+                            (b"retry-after", str(settings.ADMISSION_RETRY_AFTER).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or controller.limit <= 0:
+            return await self.app(scope, receive, send)
+        priority = classify(scope["method"], scope["path"])
+        if priority is None:
+            return await self.app(scope, receive, send)
+        if not await controller.acquire(priority):
+            logger.warning(f"Перегрузка: отклонён запрос {scope['method']} {scope['path']}")
+            return await send_overloaded(send)
+
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                controller.release()
+
+        async def send_and_release(message):
+            await send(message)
+            # Место освобождается с отправкой ответа: фоновые задачи запроса (автозакрытие двери,
+            # ожидание ответа на звонок) выполняются уже вне бюджета
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                release()
+
+        try:
+            await self.app(scope, receive, send_and_release)
+        finally:
+            release()
+
+
+@router.get("/debug/admission")
+async def admission_stats():
+    return controller.snapshot()
@@ -0,0 +1,172 @@
+# commands.py
+
+# Протокол запрос/ответ для команд management-сервиса: необязательные correlation_id и
+# reply_to (в MQTT v5 - свойства Correlation Data и Response Topic), ответ после завершения
+# перехода двери, гистограммы задержек и защита от повторного выполнения ретраев.
+
+import asyncio
+import bisect
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from fastapi import APIRouter
+
+import publisher
+import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Верхние границы корзин гистограммы задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class DedupCache:
+    # Ответы на уже выполненные команды по correlation_id: ограничен и по размеру, и по времени жизни
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def _expire(self, now: float):
+        while self.entries:
+            key, (expires, _) = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[key]
+
+    def get(self, key: str):
+        now = time.monotonic()
+        self._expire(now)
+        entry = self.entries.get(key)
+        return None if entry is None else entry[1]
+
+    def put(self, key: str, value):
+        now = time.monotonic()
+        self._expire(now)
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self) -> dict:
+        buckets = {str(bound): count for bound, count in zip(self.buckets, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": buckets}
+
+
+dedup = DedupCache(settings.COMMAND_DEDUP_SIZE, settings.COMMAND_DEDUP_TTL)
+# command -> Histogram: handling - от получения до ответа, e2e - от sent_at отправителя до ответа
+latency = {"handling": {}, "e2e": {}}
+duplicates = 0
+# Команды, которые выполняются прямо сейчас: ретрай дожидается ответа первой попытки
+_in_flight = {}
+
+
+def observe(kind: str, command: str, seconds: float):
+    latency[kind].setdefault(command, Histogram()).observe(seconds)
+
+
+def _text(value) -> str | None:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    if isinstance(value, str) and value:
+        return value
+    return None
+
+
+def reply_target(mac: str, payload: dict, properties=None) -> tuple[str | None, str | None]:
+    # Свойства MQTT v5 имеют приоритет над полями payload
+    correlation_id = _text(getattr(properties, "CorrelationData", None)) or _text(payload.get("correlation_id"))
+    reply_to = _text(getattr(properties, "ResponseTopic", None)) or _text(payload.get("reply_to"))
+    if correlation_id and not reply_to:
+        reply_to = settings.COMMAND_REPLY_TOPIC.format(mac=mac)
+    if reply_to and "/management/" in f"/{reply_to}/":
+        # Ответ в топик команд пришёл бы обратно к нам же
+        logger.warning(f"{mac} - reply_to {reply_to} совпадает с топиком команд, ответ не отправляется")
+        reply_to = None
+    return correlation_id, reply_to
+
+
+async def execute(client, mac: str, command: str, payload: dict, handler, properties=None):
+    global duplicates
+    received = time.monotonic()
+    correlation_id, reply_to = reply_target(mac, payload, properties)
+
+    key = f"{mac}/{correlation_id}"
+    if correlation_id:
+        cached = dedup.get(key)
+        if cached is None and key in _in_flight:
+            cached = await asyncio.shield(_in_flight[key])
+        if cached is not None:
+            duplicates += 1
+            logger.info(f"{mac} - повтор команды {command} ({correlation_id}), отправляем прежний ответ")
+            if reply_to:
+                await reply(client, reply_to, cached, correlation_id)
+            return cached
+        _in_flight[key] = asyncio.get_running_loop().create_future()
+
+    try:
+        result = await handler()
+        response = {"status": "ok", "result": result}
+    except Exception as e:
+        logger.error(f"{mac} - ошибка выполнения команды {command}: {e}")
+        response = {"status": "error", "error": str(e)}
+    except BaseException:
+        if correlation_id:
+            # Ответа нет - ожидающий ретрай выполнит команду сам
+            _in_flight.pop(key).set_result(None)
+        raise
+
+    elapsed = time.monotonic() - received
+    observe("handling", command, elapsed)
+    sent_at = payload.get("sent_at")
+    if isinstance(sent_at, (int, float)) and not isinstance(sent_at, bool):
+        observe("e2e", command, max(0.0, time.time() - sent_at))
+
+    response = {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "command": command,
+                "correlation_id": correlation_id,
+                **response,
+                "latency_ms": round(elapsed * 1000, 3)}
+    if correlation_id:
+        dedup.put(key, response)
+        _in_flight.pop(key).set_result(response)
+    if reply_to:
+        await reply(client, reply_to, response, correlation_id)
+    return response
+
+
+async def reply(client, topic: str, response: dict, correlation_id: str | None):
+    try:
+        await publisher.publish(client, topic, payload=response, kind="reply",
+                                correlation_data=correlation_id.encode() if correlation_id else None)
+    except Exception as e:
+        logger.error(f"Не удалось отправить ответ на команду в {topic}: {e}")
+
+
+@router.get("/debug/commands")
+async def command_stats():
+    return {"latency": {kind: {command: histogram.as_dict() for command, histogram in histograms.items()}
+                        for kind, histograms in latency.items()},
+            "duplicates": duplicates,
+            "dedup_size": len(dedup)}
@@ -0,0 +1,86 @@
+# config_loader.py
+
+# Чтение и разбор YAML-конфигов домофонов вне event loop:
+# небольшие наборы читаются в пуле потоков, большие - в пуле процессов.
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+import settings
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
+
+logger = logging.getLogger(__name__)
+
+_thread_pool = None
+_process_pool = None
+
+
+def read_config(path: Path):
+    with open(path, encoding="utf-8") as f:
+        return yaml.load(f, Loader=Loader)
+
+
+def read_configs(paths: list[Path]) -> list:
+    return [read_config(path) for path in paths]
+
+
+def list_config_files(directory: str = "doorphones") -> list[Path]:
+    return sorted(Path(directory).glob("*.yml"))
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=settings.CONFIG_IO_THREADS, thread_name_prefix="config-io")
+    return _thread_pool
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        # spawn, а не fork: процесс сервиса многопоточный, fork в нём может привести к дедлоку
+        _process_pool = ProcessPoolExecutor(max_workers=settings.CONFIG_PARSE_PROCESSES or None,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+def _chunks(items: list, size: int) -> list[list]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+async def load_configs(directory: str = "doorphones") -> list[tuple[Path, object]]:
+    # Возвращает пары (путь, разобранные данные) в порядке файлов
+    loop = asyncio.get_running_loop()
+    paths = await loop.run_in_executor(_get_thread_pool(), list_config_files, directory)
+    if not paths:
+        return []
+
+    if len(paths) >= settings.CONFIG_PROCESS_THRESHOLD:
+        executor = _get_process_pool()
+        chunk_size = settings.CONFIG_PROCESS_CHUNK
+    else:
+        executor = _get_thread_pool()
+        chunk_size = max(1, -(-len(paths) // settings.CONFIG_IO_THREADS))
+
+    chunks = _chunks(paths, chunk_size)
+    results = await asyncio.gather(*(loop.run_in_executor(executor, read_configs, chunk) for chunk in chunks))
+    return [(path, data) for chunk, chunk_data in zip(chunks, results) for path, data in zip(chunk, chunk_data)]
+
+
+def shutdown():
+    global _thread_pool, _process_pool
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -0,0 +1,41 @@
+# fleet.py
+
+# Запросы по всему парку домофонов через обратные индексы state (ключ, квартира, адрес -> MAC)
+# и массовый отзыв ключей, например при потере брелока.
+
+from typing import Optional
+
+from fastapi import APIRouter, Body, HTTPException
+
+import provisioning
+import state
+
+router = APIRouter(prefix="/fleet")
+
+
+@router.get("/keys/{key}")
+async def intercoms_by_key(key: int):
+    return {"key": key, "macs": sorted(state.key_index.get(key, ()))}
+
+
+@router.get("/apartments/{apartment}")
+async def intercoms_by_apartment(apartment: int, address: Optional[str] = None):
+    macs = state.apartment_index.get(apartment, set())
+    if address is not None:
+        macs = macs & state.address_index.get(state.address_of(address), set())
+    return {"apartment": apartment, "address": address, "macs": sorted(macs)}
+
+
+@router.get("/addresses")
+async def intercoms_by_address(address: Optional[str] = None):
+    if address is not None:
+        return {address: sorted(state.address_index.get(state.address_of(address), ()))}
+    return {addr: sorted(macs) for addr, macs in sorted(state.address_index.items())}
+
+
+@router.post("/keys/revoke")
+async def revoke_keys(keys: list = Body(..., embed=True)):
+    try:
+        return {"revoked": await provisioning.revoke_keys(keys)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
@@ -9,9 +9,13 @@ import logging
 from starlette.responses import RedirectResponse
 from starlette.templating import Jinja2Templates
 
+import journal
+import publisher
+import rollup
+import settings
 import state
+import static_assets
 
-import json
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
@@ -19,13 +23,46 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["static_url"] = static_assets.url
 
 
-async def open_door(current_mac: str, code: Optional[int] = None, management_message: Optional[str] = None):
-    if state.door_phones[current_mac]['door_status'] == 'closed':
-        state.door_phones[current_mac]['door_status'] = 'open'
-        logger.info(f'Door status changed: {state.door_phones[current_mac]['door_status']}')
-
+async def publish_message(current_mac: str, payload: dict) -> bool:
+    topic = f'intercom/{current_mac}/message'
+    if settings.ROLLUP_ENABLED:
+        rollup.record(current_mac, payload)
+        if not settings.ROLLUP_RAW_EVENTS:
+            # Отдельные события не отправляются - в журнал только для истории
+            journal.append(current_mac, topic, payload, published=True)
+            return True
+    try:
+        async with Client("mqtt", **publisher.client_options()) as client:
+            await publisher.publish(client, topic, payload=payload)
+    except Exception as e:
+        logger.error(e)
+        journal.append(current_mac, topic, payload, published=False)
+        return False
+    journal.append(current_mac, topic, payload, published=True)
+    return True
+
+
+async def open_door(current_mac: str, code: Optional[int] = None, management_message: Optional[str] = None) -> dict:
+    # Запросы на открытие, пришедшие пока дверь открывается или уже открыта, объединяются
+    # с текущим переходом: одно событие в MQTT, но результат получает каждый
+    in_flight = state.door_opening.get(current_mac)
+    if in_flight is not None:
+        return {**await asyncio.shield(in_flight), "coalesced": True}
+
+    door = state.door_phones[current_mac]
+    version = door.get('door_version', 0)
+    if door['door_status'] != 'closed' or not state.door_transition(current_mac, version, 'closed', 'open'):
+        return {"door_status": door['door_status'], "version": door.get('door_version', 0),
+                "published": False, "coalesced": True}
+    logger.info(f'Door status changed: {state.door_phones[current_mac]['door_status']}')
+
+    in_flight = asyncio.get_running_loop().create_future()
+    state.door_opening[current_mac] = in_flight
+    result = {"door_status": "open", "version": version + 1, "published": False, "coalesced": False}
+    try:
         if code:
             payload = {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                        "event": "key",
@@ -43,50 +80,65 @@ async def open_door(current_mac: str, code: Optional[int] = None, management_mes
                        "status": "success",
                        "door_status": state.door_phones[current_mac]['door_status']}
 
-        try:
-            async with Client("mqtt") as client:
-                await client.publish(f'intercom/{current_mac}/message',
-                                     payload=json.dumps(payload),
-                                     qos=1)
-                logger.info(f'{current_mac} - Дверь открыта')
-        except Exception as e:
-            logger.error(e)
+        if await publish_message(current_mac, payload):
+            result["published"] = True
+            logger.info(f'{current_mac} - Дверь открыта')
+    finally:
+        state.door_opening.pop(current_mac, None)
+        in_flight.set_result(result)
+    return result
 
 
 async def auto_close_door(current_mac: str):
-    if state.door_phones[current_mac]['door_status'] == 'open':
+    door = state.door_phones[current_mac]
+    if door['door_status'] != 'open':
+        return
+    # На одно открытие - один таймер закрытия, повторные вызовы для той же версии игнорируются
+    version = door.get('door_version', 0)
+    if state.close_timers.get(current_mac) == version:
+        return
+    state.close_timers[current_mac] = version
+    try:
         await asyncio.sleep(10)
-        state.door_phones[current_mac]['door_status'] = 'closed'
+        if not state.door_transition(current_mac, version, 'open', 'closed'):
+            return
         logger.info(f'Door status changed: {state.door_phones[current_mac]['door_status']}')
-        try:
-            async with Client("mqtt") as client:
-                await client.publish(f'intercom/{current_mac}/message',
-                                     payload=json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                         "event": "auto-close",
-                                                         "status": "success",
-                                                         "door_status": state.door_phones[current_mac]['door_status']}),
-                                     qos=1)
-                logger.info(f'{current_mac} - Дверь закрыта')
-        except Exception as e:
-            logger.error(e)
+        if await publish_message(current_mac, {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                               "event": "auto-close",
+                                               "status": "success",
+                                               "door_status": state.door_phones[current_mac]['door_status']}):
+            logger.info(f'{current_mac} - Дверь закрыта')
+    finally:
+        if state.close_timers.get(current_mac) == version:
+            del state.close_timers[current_mac]
+
+
+async def close_door(current_mac: str, management_message: str) -> dict:
+    door = state.door_phones[current_mac]
+    version = door.get('door_version', 0)
+    if door['door_status'] != 'open' or not state.door_transition(current_mac, version, 'open', 'closed'):
+        return {"door_status": door['door_status'], "version": door.get('door_version', 0), "published": False}
+    # Таймер автозакрытия этой версии после перехода ничего не сделает
+    logger.info(f'Door status changed: {state.door_phones[current_mac]['door_status']}')
+    published = await publish_message(current_mac, {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                     "event": management_message,
+                                                     "status": "success",
+                                                     "door_status": state.door_phones[current_mac]['door_status']})
+    if published:
+        logger.info(f'{current_mac} - Дверь закрыта')
+    return {"door_status": "closed", "version": version + 1, "published": published}
 
 
 @router.post('/{current_mac}/open-door-key')
 async def key(request: Request, background_tasks: BackgroundTasks, code: str = Form(...),
               current_mac: str = Path(..., min_length=17, max_length=17)):
-    if not code.isdigit() or int(code) not in state.door_phones[current_mac]['allowed_keys']:
-        try:
-            async with Client("mqtt") as client:
-                await client.publish(f'intercom/{current_mac}/message',
-                                     payload=json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                         "event": "key",
-                                                         "status": "fail",
-                                                         "reason": "incorrect key",
-                                                         "door_status": state.door_phones[current_mac]['door_status']}),
-                                     qos=1)
-                logger.info(f'{current_mac} - Дверь закрыта')
-        except Exception as e:
-            logger.error(e)
+    if not code.isdigit() or not state.key_allowed(current_mac, int(code)):
+        if await publish_message(current_mac, {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                               "event": "key",
+                                               "status": "fail",
+                                               "reason": "incorrect key",
+                                               "door_status": state.door_phones[current_mac]['door_status']}):
+            logger.info(f'{current_mac} - Дверь закрыта')
         return RedirectResponse(f"/{current_mac}?error_message=Ключ+не+подходит", status_code=303)
     await open_door(current_mac, int(code))
     background_tasks.add_task(auto_close_door, current_mac)
@@ -153,14 +205,8 @@ async def call_wait_response(current_mac: str):
                "result": result,
                "door_status": state.door_phones[current_mac]['door_status']}
 
-    try:
-        async with Client("mqtt") as client:
-            await client.publish(f'intercom/{current_mac}/message',
-                                 payload=json.dumps(payload),
-                                 qos=1)
-            logger.info(f'{current_mac} - Отправлено сообщение об результатах звонка')
-    except Exception as e:
-        logger.error(e)
+    if await publish_message(current_mac, payload):
+        logger.info(f'{current_mac} - Отправлено сообщение об результатах звонка')
 
     state.clear_call_event(current_mac)
     state.call_results.pop(current_mac, None)
@@ -176,37 +222,25 @@ async def call(request: Request, background_tasks: BackgroundTasks, apartment_nu
     logger.info(f"current_status - {current_status}")
     if current_status != "calling":
         if not apartment_number.isdigit() or int(apartment_number) not in state.door_phones[current_mac]['apartments']:
-            try:
-                async with Client("mqtt") as client:
-                    await client.publish(f'intercom/{current_mac}/message',
-                                         payload=json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                             "event": "call-start",
-                                                             "apartment": apartment_number,
-                                                             "location": state.door_phones[current_mac]['location'],
-                                                             "status": "fail",
-                                                             "reason": "incorrect apartment",
-                                                             "door_status": state.door_phones[current_mac]['door_status']}),
-                                         qos=1)
-                    logger.info(f'{current_mac} - Неверный номер квартиры')
-            except Exception as e:
-                logger.error(e)
+            if await publish_message(current_mac, {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                   "event": "call-start",
+                                                   "apartment": apartment_number,
+                                                   "location": state.door_phones[current_mac]['location'],
+                                                   "status": "fail",
+                                                   "reason": "incorrect apartment",
+                                                   "door_status": state.door_phones[current_mac]['door_status']}):
+                logger.info(f'{current_mac} - Неверный номер квартиры')
             return RedirectResponse(f"/{current_mac}?error_message=Неверный+номер+квартиры", status_code=303)
         state.call_results[current_mac] = "calling"
         logger.info(f"current_status - {state.call_results[current_mac]}")
         background_tasks.add_task(call_wait_response, current_mac)
-        try:
-            async with Client("mqtt") as client:
-                await client.publish(f'intercom/{current_mac}/message',
-                                     payload=json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                         "event": "call-start",
-                                                         "apartment": apartment_number,
-                                                         "location": state.door_phones[current_mac]['location'],
-                                                         "status": "success",
-                                                         "door_status": state.door_phones[current_mac]['door_status']}),
-                                     qos=1)
-                logger.info(f'{current_mac} - Звонок в квартиру {apartment_number}')
-        except Exception as e:
-            logger.error(e)
+        if await publish_message(current_mac, {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                               "event": "call-start",
+                                               "apartment": apartment_number,
+                                               "location": state.door_phones[current_mac]['location'],
+                                               "status": "success",
+                                               "door_status": state.door_phones[current_mac]['door_status']}):
+            logger.info(f'{current_mac} - Звонок в квартиру {apartment_number}')
         return templates.TemplateResponse(request, "call.html", {
             "apartment_number": apartment_number,
             "current_mac": current_mac
@@ -0,0 +1,364 @@
+# journal.py
+
+# Локальный журнал событий двери: append-only сегменты на диске.
+# Чтение идёт через mmap, в памяти держатся разреженный индекс по времени
+# и индекс по mac для каждого сегмента.
+
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_right
+from pathlib import Path
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Заголовок записи: длина тела, время (unix), порядковый номер, флаг "отправлено в MQTT"
+HEADER = struct.Struct("<IdQB")
+SEGMENT_SUFFIX = ".seg"
+DELIVERED_FILE = "delivered.log"
+SEQ = struct.Struct("<Q")
+
+
+class Segment:
+    def __init__(self, path: Path):
+        self.path = path
+        self.size = 0
+        self.first_ts = None
+        self.first_seq = None
+        self.last_ts = None
+        self.last_seq = None
+        self.count = 0
+        self.time_index = []  # [(ts, offset)] каждые JOURNAL_INDEX_INTERVAL записей
+        self.mac_index = {}  # mac -> [offset]
+
+    def index_record(self, offset: int, ts: float, seq: int, mac: str):
+        if self.count % settings.JOURNAL_INDEX_INTERVAL == 0:
+            self.time_index.append((ts, offset))
+        self.mac_index.setdefault(mac, []).append(offset)
+        if self.first_ts is None:
+            self.first_ts = ts
+            self.first_seq = seq
+        self.last_ts = ts
+        self.last_seq = seq
+        self.count += 1
+
+    def read(self, offsets=None, start: int = 0):
+        # Генератор (offset, header, record) - по списку offsets или подряд начиная со start
+        if self.size == 0:
+            return
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ) as mm:
+            if offsets is not None:
+                for offset in offsets:
+                    yield self._read_at(mm, offset)
+                return
+            offset = start
+            while offset < self.size:
+                item = self._read_at(mm, offset)
+                yield item
+                offset = item[0] + HEADER.size + item[1][0]
+
+    @staticmethod
+    def _read_at(mm, offset: int):
+        header = HEADER.unpack_from(mm, offset)
+        body = mm[offset + HEADER.size:offset + HEADER.size + header[0]]
+        return offset, header, json.loads(body)
+
+    def seek_time(self, since: float) -> int:
+        # Ближайшая точка разреженного индекса не позже since
+        pos = bisect_right(self.time_index, (since, float("inf"))) - 1
+        return self.time_index[pos][1] if pos >= 0 else 0
+
+
+class Journal:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segments = []
+        self.seq = 0
+        self.pending = {}  # seq -> (segment, offset) для событий, не дошедших до MQTT
+        self.delivered = set()
+        self._active = None
+        self._load()
+
+    def _load(self):
+        delivered_path = self.directory / DELIVERED_FILE
+        if delivered_path.exists():
+            data = delivered_path.read_bytes()
+            self.delivered = {SEQ.unpack_from(data, i)[0] for i in range(0, len(data) - len(data) % SEQ.size, SEQ.size)}
+        for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            segment = Segment(path)
+            segment.size = path.stat().st_size
+            if self._compacted_leftover(segment):
+                # Сжатие прервалось после записи склеенного сегмента - его исходники уже в нём
+                logger.warning(f"Журнал: удалён остаток прерванного сжатия {path.name}")
+                path.unlink()
+                continue
+            self._index_segment(segment)
+            self.segments.append(segment)
+        self.delivered &= set(self.pending)
+        for seq in self.delivered:
+            self.pending.pop(seq, None)
+
+    def _compacted_leftover(self, segment: Segment) -> bool:
+        if not self.segments or self.segments[-1].last_seq is None or segment.size < HEADER.size:
+            return False
+        with open(segment.path, "rb") as f:
+            _, _, seq, _ = HEADER.unpack(f.read(HEADER.size))
+        return seq <= self.segments[-1].last_seq
+
+    def _index_segment(self, segment: Segment):
+        valid_size = 0
+        try:
+            for offset, (length, ts, seq, published), record in segment.read():
+                segment.index_record(offset, ts, seq, record["mac"])
+                if not published:
+                    self.pending[seq] = (segment, offset)
+                self.seq = max(self.seq, seq)
+                valid_size = offset + HEADER.size + length
+        except (struct.error, ValueError) as e:
+            # Недописанная запись в конце сегмента (падение во время записи) - отрезаем
+            logger.warning(f"Журнал: повреждённый хвост сегмента {segment.path.name} обрезан ({e})")
+            with open(segment.path, "r+b") as f:
+                f.truncate(valid_size)
+            segment.size = valid_size
+
+    def _open_active(self) -> Segment:
+        if self.segments and self.segments[-1].size < settings.JOURNAL_SEGMENT_BYTES:
+            segment = self.segments[-1]
+        else:
+            segment = Segment(self.directory / f"{self.seq + 1:020d}{SEGMENT_SUFFIX}")
+            self.segments.append(segment)
+        if self._active is not None:
+            self._active[1].close()
+        self._active = (segment, open(segment.path, "ab"))
+        return segment
+
+    def append(self, mac: str, topic: str, payload: dict, published: bool, ts: Optional[float] = None) -> int:
+        ts = time.time() if ts is None else ts
+        if self._active is None or self._active[0].size >= settings.JOURNAL_SEGMENT_BYTES:
+            self._open_active()
+        segment, f = self._active
+        self.seq += 1
+        body = json.dumps({"seq": self.seq, "ts": ts, "mac": mac, "topic": topic, "payload": payload},
+                          ensure_ascii=False).encode("utf-8")
+        offset = segment.size
+        f.write(HEADER.pack(len(body), ts, self.seq, 1 if published else 0) + body)
+        f.flush()
+        if settings.JOURNAL_FSYNC:
+            os.fsync(f.fileno())
+        segment.size += HEADER.size + len(body)
+        segment.index_record(offset, ts, self.seq, mac)
+        if not published:
+            self.pending[self.seq] = (segment, offset)
+        return self.seq
+
+    def query(self, mac: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+              limit: int = 100, cursor: Optional[int] = None) -> tuple[list, Optional[int]]:
+        # cursor - seq последней выданной записи, выдача идёт по возрастанию времени записи
+        items = []
+        for segment in self.segments:
+            if segment.count == 0:
+                continue
+            if cursor is not None and segment.last_seq <= cursor:
+                continue
+            if since is not None and segment.last_ts < since:
+                continue
+            if until is not None and segment.first_ts > until:
+                break
+            if mac is not None:
+                if mac not in segment.mac_index:
+                    continue
+                records = segment.read(offsets=segment.mac_index[mac])
+            else:
+                records = segment.read(start=segment.seek_time(since) if since is not None else 0)
+            for _, (_, ts, seq, _), record in records:
+                if cursor is not None and seq <= cursor:
+                    continue
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts > until:
+                    return items, None
+                if mac is not None and record["mac"] != mac:
+                    continue
+                items.append(record)
+                if len(items) >= limit:
+                    return items, seq
+        return items, None
+
+    def pending_records(self, limit: int = 100) -> list:
+        records = []
+        for seq in sorted(self.pending)[:limit]:
+            segment, offset = self.pending[seq]
+            _, _, record = next(segment.read(offsets=[offset]))
+            records.append(record)
+        return records
+
+    def mark_delivered(self, seqs):
+        seqs = [seq for seq in seqs if seq in self.pending]
+        if not seqs:
+            return
+        with open(self.directory / DELIVERED_FILE, "ab") as f:
+            f.write(b"".join(SEQ.pack(seq) for seq in seqs))
+        for seq in seqs:
+            self.pending.pop(seq, None)
+            self.delivered.add(seq)
+
+    async def compact(self, now: Optional[float] = None):
+        # Сжатие закрытых сегментов: удаляем записи старше срока хранения,
+        # проставляем флаг отправки доставленным и склеиваем мелкие сегменты.
+        # Чтение и запись файлов идут в пуле, состояние журнала меняется только в event loop
+        now = time.time() if now is None else now
+        cutoff = now - settings.JOURNAL_RETENTION_SECONDS
+        # Последний сегмент не трогаем: в него может продолжиться запись
+        active = self._active[0] if self._active is not None else None
+        sealed = [segment for segment in self.segments[:-1] if segment is not active]
+        if not sealed:
+            return
+        delivered = frozenset(self.delivered)
+        plan = await asyncio.to_thread(self._rewrite, sealed, cutoff, delivered)
+        if plan:
+            self._apply(sealed, delivered, plan)
+
+    def _batches(self, sealed: list) -> list:
+        batches, batch, batch_size = [], [], 0
+        for segment in sealed:
+            if batch and batch_size + segment.size > settings.JOURNAL_SEGMENT_BYTES:
+                batches.append(batch)
+                batch, batch_size = [], 0
+            batch.append(segment)
+            batch_size += segment.size
+        batches.append(batch)
+        return batches
+
+    def _rewrite(self, sealed: list, cutoff: float, delivered: frozenset) -> list:
+        # Выполняется в пуле: только читает закрытые сегменты и пишет временные файлы.
+        # Результат - [(batch, merged, tmp_path, {seq: offset} неотправленных)],
+        # merged is None - пачка удаляется целиком
+        plan = []
+        for batch in self._batches(sealed):
+            if all(segment.last_ts is None or segment.last_ts < cutoff for segment in batch):
+                plan.append((batch, None, None, {}))
+                continue
+            if len(batch) == 1 and batch[0].first_ts >= cutoff and not any(
+                    batch[0].first_seq <= seq <= batch[0].last_seq for seq in delivered):
+                # Нечего удалять, склеивать и отмечать - сегмент остаётся как есть
+                continue
+            records = []
+            for segment in batch:
+                for _, (_, ts, seq, published), record in segment.read():
+                    if ts < cutoff:
+                        continue
+                    records.append((ts, seq, published or seq in delivered, record))
+            if not records:
+                plan.append((batch, None, None, {}))
+                continue
+            # Склеенный сегмент получает имя первого в пачке и заменяет его одним os.replace
+            merged = Segment(batch[0].path)
+            tmp_path = merged.path.with_suffix(".tmp")
+            unpublished = {}
+            with open(tmp_path, "wb") as f:
+                for ts, seq, published, record in records:
+                    body = json.dumps(record, ensure_ascii=False).encode("utf-8")
+                    offset = merged.size
+                    f.write(HEADER.pack(len(body), ts, seq, 1 if published else 0) + body)
+                    merged.size += HEADER.size + len(body)
+                    merged.index_record(offset, ts, seq, record["mac"])
+                    if not published:
+                        unpublished[seq] = offset
+                f.flush()
+                os.fsync(f.fileno())
+            plan.append((batch, merged, tmp_path, unpublished))
+        return plan
+
+    def _apply(self, sealed: list, delivered: frozenset, plan: list):
+        replaced = {}
+        for batch, merged, tmp_path, unpublished in plan:
+            for segment in batch:
+                self._drop_pending(segment)
+            rest = batch
+            if merged is not None:
+                # Сначала новый сегмент занимает место первого, потом удаляются остальные:
+                # при падении между шагами записи не теряются, остатки удаляются при загрузке
+                os.replace(tmp_path, merged.path)
+                replaced[batch[0]] = merged
+                rest = batch[1:]
+                for seq, offset in unpublished.items():
+                    # Доставленные за время сжатия уже ушли из delivered-лога в self.delivered
+                    if seq not in self.delivered:
+                        self.pending[seq] = (merged, offset)
+            for segment in rest:
+                segment.path.unlink(missing_ok=True)
+                replaced[segment] = None
+
+        segments = []
+        for segment in self.segments:
+            if segment in replaced:
+                if replaced[segment] is not None:
+                    segments.append(replaced[segment])
+            else:
+                segments.append(segment)
+        self.segments = segments
+        # Флаги доставки перенесены в закрытые сегменты - оставляем только те, что пришли во время
+        # сжатия или относятся к более новым сегментам
+        boundary = max(segment.last_seq or 0 for segment in sealed)
+        self.delivered = {seq for seq in self.delivered if seq > boundary or seq not in delivered}
+        with open(self.directory / DELIVERED_FILE, "wb") as f:
+            f.write(b"".join(SEQ.pack(seq) for seq in sorted(self.delivered)))
+        logger.info(f"Журнал: сжатие завершено, переписано пачек: {len(plan)}, сегментов: {len(self.segments)}")
+
+    def _drop_pending(self, segment: Segment):
+        for seq in [seq for seq, (pending_segment, _) in self.pending.items() if pending_segment is segment]:
+            del self.pending[seq]
+
+    def close(self):
+        if self._active is not None:
+            self._active[1].close()
+            self._active = None
+
+
+current: Optional[Journal] = None
+
+
+def open_journal() -> Optional[Journal]:
+    global current
+    if settings.JOURNAL_ENABLED and current is None:
+        current = Journal(settings.JOURNAL_DIR)
+        logger.info(f"Журнал событий: {settings.JOURNAL_DIR}, неотправленных событий: {len(current.pending)}")
+    return current
+
+
+def close_journal():
+    global current
+    if current is not None:
+        current.close()
+        current = None
+
+
+def append(mac: str, topic: str, payload: dict, published: bool):
+    if current is None:
+        return
+    try:
+        current.append(mac, topic, payload, published)
+    except Exception as e:
+        logger.error(f"Ошибка записи в журнал: {e}")
+
+
+@router.get("/journal")
+async def journal_events(mac: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                         limit: int = 100, cursor: Optional[int] = None):
+    if current is None:
+        raise HTTPException(status_code=404, detail="Журнал событий отключен")
+    items, next_cursor = current.query(mac=mac, since=since, until=until,
+                                       limit=max(1, min(limit, 1000)), cursor=cursor)
+    return {"items": items, "next_cursor": next_cursor}
@@ -2,55 +2,144 @@ import uvicorn
 import fastapi
 from fastapi import FastAPI, Request, Path
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
 from typing import Optional
+from pydantic import BaseModel, StrictInt
 
 import logging
 
 from contextlib import asynccontextmanager
 from aiomqtt import Client
 import asyncio
+import importlib.util
+import json
+import os
+import time
 
 from starlette.responses import RedirectResponse
 
+import admission
+import commands
+import config_loader
+import fleet
 import functions
+import journal
+import monitoring
+import provisioning
+import publisher
+import rollup
+import schedules
+import settings
+import static_assets
+import subscriber
+import topic_router
 
-import yaml
 from pathlib import Path
 import state
 
-import json
 from datetime import datetime
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# Фоновые задачи, которые нужно дождаться при остановке сервиса
+background_tasks = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def drain_background_tasks(timeout: float):
+    if not background_tasks:
+        return
+    logger.info(f"Ожидание завершения фоновых задач: {len(background_tasks)}")
+    _, pending = await asyncio.wait(set(background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning(f"Фоновые задачи не завершились за {timeout} с и отменены: {len(pending)}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     task_check = asyncio.create_task(check_intercom())
     task_life = asyncio.create_task(send_life())
     task_message = asyncio.create_task(listen_for_messages())
+    task_journal = None
+    if journal.open_journal() is not None:
+        task_journal = asyncio.create_task(maintain_journal())
+    monitor_tasks = monitoring.start()
+    task_provision = asyncio.create_task(provisioning.flush_periodically())
+    task_purge = asyncio.create_task(provisioning.purge_periodically())
+    task_rollup = asyncio.create_task(rollup.flush_periodically()) if settings.ROLLUP_ENABLED else None
     yield
+    # Сначала перестаём принимать команды, затем дожидаемся начатых открытий/закрытий двери
+    task_message.cancel()
     task_check.cancel()
     task_life.cancel()
-    task_message.cancel()
+    await drain_background_tasks(settings.SERVER_DRAIN_TIMEOUT)
+    for task in monitor_tasks:
+        task.cancel()
+    monitoring.stop()
+    task_purge.cancel()
+    task_provision.cancel()
+    await provisioning.flush()
+    if task_rollup is not None:
+        task_rollup.cancel()
+        await rollup.flush()
+    config_loader.shutdown()
+    if task_journal is not None:
+        task_journal.cancel()
+    journal.close_journal()
 
 
 async def send_life():
     while True:
         try:
-            async with Client("mqtt") as client:
-                for mac in state.door_phones.keys():
-                    await client.publish(f'intercom/{mac}/life',
-                                         payload=json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                             "status": "online"}), qos=1)
-                    logger.info(f"Отправка сигнала о работе: {mac}")
+            # Держим одно соединение между циклами, чтобы алиасы топиков переиспользовались
+            async with Client("mqtt", **publisher.client_options()) as client:
+                while True:
+                    if settings.MQTT_LIFE_DIGEST:
+                        await send_life_digest(client)
+                    else:
+                        for mac in list(state.door_phones.keys()):
+                            await publisher.publish(client, f'intercom/{mac}/life',
+                                                    payload={"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                             "status": "online"}, kind="life")
+                            logger.info(f"Отправка сигнала о работе: {mac}")
+                    await asyncio.sleep(10)
         except Exception as e:
             logger.error(f"MQTT error: {e}")
         await asyncio.sleep(10)
 
 
+async def send_life_digest(client):
+    macs = list(state.door_phones.keys())
+    state.life_digest_seq += 1
+    await publisher.publish(client, settings.MQTT_LIFE_DIGEST_TOPIC,
+                            payload={"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                     "seq": state.life_digest_seq,
+                                     "online": macs}, kind="life")
+    logger.info(f"Отправка сводного сигнала о работе: {len(macs)} домофонов, seq={state.life_digest_seq}")
+
+    # Индивидуальный life - только при появлении домофона и для домофонов без недавних сообщений
+    now = time.monotonic()
+    for mac in macs:
+        last = publisher.last_activity(mac)
+        if mac in state.life_reported and last is not None and now - last < settings.MQTT_LIFE_DIGEST_KEEPALIVE:
+            continue
+        await publisher.publish(client, f'intercom/{mac}/life',
+                                payload={"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                         "status": "online"}, kind="life")
+        state.life_reported.add(mac)
+        logger.info(f"Отправка сигнала о работе: {mac}")
+    state.life_reported &= set(macs)
+
+
 def is_valid_config(data: dict):
     if not isinstance(data, dict):
         return False
@@ -65,105 +154,352 @@ def is_valid_config(data: dict):
         return False
     if not isinstance(data["apartments"], list) or not all(isinstance(a, int) for a in data["apartments"]):
         return False
+    if "scheduled_keys" in data and not schedules.is_valid(data["scheduled_keys"]):
+        return False
+    if "version" in data and (not isinstance(data["version"], int) or isinstance(data["version"], bool)
+                              or data["version"] < 0):
+        return False
     return True
 
 
+def config_event(mac: str, event: str, **configs) -> dict:
+    return {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "event": event,
+            "version": state.config_versions.get(mac, 0),
+            **configs}
+
+
+async def load_retained_configs() -> tuple[dict, dict]:
+    # Читаем текущие retained-конфиги из брокера, чтобы после перезапуска не публиковать весь парк заново.
+    # Результат - конфиги и их версии
+    configs = {}
+    versions = {}
+    async with Client("mqtt", **publisher.client_options()) as client:
+        await client.subscribe("intercom/+/config", qos=1)
+        messages = aiter(client.messages)
+        try:
+            async with asyncio.timeout(settings.CONFIG_RECONCILE_TIMEOUT):
+                while True:
+                    message = await asyncio.wait_for(anext(messages), settings.CONFIG_RECONCILE_IDLE)
+                    if not message.retain or not message.payload:
+                        continue
+                    mac = str(message.topic).split("/")[1]
+                    data = publisher.decode(message.payload, message.properties)
+                    if data.get("event") in ("added", "modified") and "new_config" in data:
+                        configs[mac] = data["new_config"]
+                    else:
+                        configs.pop(mac, None)
+                    if "version" in data:
+                        versions[mac] = data["version"]
+        except (TimeoutError, StopAsyncIteration):
+            pass
+    return configs, versions
+
+
+def load_config_snapshot() -> dict:
+    with open(settings.CONFIG_SNAPSHOT_FILE, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_config_snapshot(configs: dict):
+    tmp_path = f"{settings.CONFIG_SNAPSHOT_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(configs, f, ensure_ascii=False)
+    os.replace(tmp_path, settings.CONFIG_SNAPSHOT_FILE)
+
+
+async def read_config_snapshot() -> dict | None:
+    if not settings.CONFIG_SNAPSHOT_FILE:
+        return None
+    try:
+        return await asyncio.to_thread(load_config_snapshot)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Не удалось прочитать снимок конфигов: {e}")
+    return None
+
+
+async def reconcile_configs(local_macs: set):
+    # В брокере могут быть retained-конфиги домофонов других экземпляров сервиса: в базу сверки
+    # берём только свои - из локальных файлов и из снимка прошлого запуска (удалённые, пока сервис
+    # был остановлен). Иначе чужие домофоны попали бы в deleted и были бы "удалены" из брокера
+    snapshot = await read_config_snapshot()
+    if settings.CONFIG_RECONCILE:
+        try:
+            retained, versions = await load_retained_configs()
+            owned = local_macs | set(snapshot or {})
+            state.previous_configs = {mac: config for mac, config in retained.items() if mac in owned}
+            for mac in owned & set(versions):
+                state.seed_config_version(mac, versions[mac])
+            logger.info(f"Сверка с retained-конфигами: {len(state.previous_configs)} домофонов "
+                        f"(пропущено чужих: {len(retained) - len(state.previous_configs)})")
+            return
+        except Exception as e:
+            logger.error(f"Не удалось прочитать retained-конфиги: {e}")
+    if snapshot is not None:
+        state.previous_configs = snapshot
+        logger.info(f"Сверка с сохранённым снимком конфигов: {len(state.previous_configs)} домофонов")
+
+
+def provisioned_since(versions: dict, dirty: set) -> set:
+    # Домофоны, чьи дельты были не сохранены до начала чтения файлов или пришли во время него:
+    # flush мог записать файл и снять флаг, пока читались старые версии файлов
+    return dirty | state.provision_dirty | {mac for mac, version in state.config_versions.items()
+                                            if versions.get(mac) != version}
+
+
 async def check_intercom():
     while True:
         try:
+            versions = dict(state.config_versions)
+            dirty = set(state.provision_dirty)
+            # Чтение и разбор файлов идут в пуле, в event loop - только проверка и обновление state
             configs = []
-            for path in Path("doorphones").glob("*.yml"):
-                with open(path, encoding="utf-8") as f:
-                    data = yaml.safe_load(f)
-                    if not is_valid_config(data):
-                        logger.warning(f"Файл {path.name} имеет неверный формат и будет пропущен")
-                        continue
-                    configs.append(data)
+            config_paths = {}
+            file_versions = {}
+            for path, data in await config_loader.load_configs("doorphones"):
+                if not is_valid_config(data):
+                    logger.warning(f"Файл {path.name} имеет неверный формат и будет пропущен")
+                    continue
+                if "scheduled_keys" in data:
+                    data["scheduled_keys"] = schedules.normalize(data["scheduled_keys"])
+                file_versions[data["mac"]] = data.pop("version", 0)
+                configs.append(data)
+                config_paths[data["mac"]] = path
+            state.config_paths = config_paths
+            provisioned = provisioned_since(versions, dirty)
 
             new_configs = {cfg["mac"]: cfg for cfg in configs}
+            for mac, version in file_versions.items():
+                state.seed_config_version(mac, version)
+            if not state.configs_loaded:
+                await reconcile_configs(set(new_configs))
+            # Домофоны с дельтами: актуальна версия в памяти, а не прочитанный файл
+            for mac in provisioned & set(new_configs) & set(state.previous_configs):
+                new_configs[mac] = state.previous_configs[mac]
+            configs = list(new_configs.values())
             added = set(new_configs) - set(state.previous_configs)
             deleted = set(state.previous_configs) - set(new_configs)
             modified = {mac for mac in new_configs
                         if mac in state.previous_configs and new_configs[mac] != state.previous_configs[mac]}
+            # Изменение файла - тоже новая версия конфига
+            for mac in added | deleted | modified:
+                state.bump_config_version(mac)
+            versions = dict(state.config_versions)
 
-            if added or deleted or modified:
+            changed = bool(added or deleted or modified)
+            if changed or not state.configs_loaded:
                 state.update_doorphones(configs)
+                state.configs_loaded = True
 
-                async with Client("mqtt") as client:
+            if changed:
+                async with Client("mqtt", **publisher.client_options()) as client:
                     for mac in added:
-                        await client.publish(f"intercom/{mac}/config", payload=json.dumps({
-                            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "event": "added",
-                            "new_config": new_configs[mac]
-                        }), qos=1, retain=True)
+                        await publisher.publish(client, f"intercom/{mac}/config",
+                                                payload=config_event(mac, "added", new_config=new_configs[mac]),
+                                                kind="config", retain=True)
                         logger.info(f"[MQTT] Подключен домофон: {mac}")
 
                     for mac in deleted:
-                        await client.publish(f"intercom/{mac}/config", payload=json.dumps({
-                            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "event": "removed",
-                            "old_config": state.previous_configs[mac]
-                        }), qos=1, retain=True)
-                        await client.publish(f'intercom/{mac}/life',
-                                             payload=json.dumps({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                                                 "status": "deleted"}), qos=1)
+                        await publisher.publish(client, f"intercom/{mac}/config",
+                                                payload=config_event(mac, "removed",
+                                                                     old_config=state.previous_configs[mac]),
+                                                kind="config", retain=True)
+                        await publisher.publish(client, f'intercom/{mac}/life',
+                                                payload={"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                                         "status": "deleted"})
                         logger.info(f"[MQTT] Удалён домофон: {mac}")
 
                     for mac in modified:
-                        await client.publish(f"intercom/{mac}/config", payload=json.dumps({
-                            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "event": "modified",
-                            "new_config": new_configs[mac],
-                            "old_config": state.previous_configs[mac]
-                        }), qos=1, retain=True)
+                        await publisher.publish(client, f"intercom/{mac}/config",
+                                                payload=config_event(mac, "modified", new_config=new_configs[mac],
+                                                                     old_config=state.previous_configs[mac]),
+                                                kind="config", retain=True)
                         logger.info(f"[MQTT] Изменён домофон: {mac}")
 
+                # Дельты, пришедшие во время публикации
+                for mac in (provisioned | provisioned_since(versions, set())) & set(new_configs) & set(state.previous_configs):
+                    new_configs[mac] = state.previous_configs[mac]
                 state.previous_configs = new_configs
+                if settings.CONFIG_SNAPSHOT_FILE:
+                    await asyncio.to_thread(save_config_snapshot, new_configs)
 
             logger.info("Проверка конфигов завершена")
-            logger.info(f"{state.get_all_configs()}")
+            logger.debug("%s", state.get_all_configs())
 
         except Exception as e:
             logger.error(f"Ошибка при загрузке конфигов: {e}")
         await asyncio.sleep(10)
 
 
-async def listen_for_messages():
+async def replay_journal():
+    records = journal.current.pending_records()
+    if not records:
+        return
+    delivered = []
+    try:
+        async with Client("mqtt", **publisher.client_options()) as client:
+            for record in records:
+                await publisher.publish(client, record["topic"], payload=record["payload"])
+                delivered.append(record["seq"])
+    except Exception as e:
+        logger.error(f"Журнал: ошибка повторной отправки: {e}")
+    journal.current.mark_delivered(delivered)
+    if delivered:
+        logger.info(f"Журнал: повторно отправлено событий: {len(delivered)}")
+
+
+async def maintain_journal():
+    last_compact = time.monotonic()
     while True:
         try:
-            async with Client("mqtt") as client:
-                await client.subscribe("intercom/+/management/#")
+            await replay_journal()
+            if time.monotonic() - last_compact >= settings.JOURNAL_COMPACT_INTERVAL:
+                await journal.current.compact()
+                last_compact = time.monotonic()
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания журнала: {e}")
+        await asyncio.sleep(10)
+
+
+mqtt_router = topic_router.TopicRouter()
+
+
+class DoorCommand(BaseModel):
+    event: Optional[str] = None
+
+
+class CloseCommand(BaseModel):
+    reason: str = "forced-close"
+
+
+class ProvisionCommand(BaseModel):
+    add_keys: list[StrictInt] = []
+    remove_keys: list[StrictInt] = []
+    add_apartments: list[StrictInt] = []
+    remove_apartments: list[StrictInt] = []
+
+
+class EmptyCommand(BaseModel):
+    pass
+
+
+@mqtt_router.route("intercom/{mac}/management/provision", name="provision", schema=ProvisionCommand, concurrency=4)
+@mqtt_router.route("intercom/{mac}/management/keys", name="keys", schema=ProvisionCommand, concurrency=4)
+async def handle_provision(client, command: ProvisionCommand, mac: str):
+    result = await provisioning.apply_delta(mac, command.model_dump())
+    logger.info(f"{mac} - дельта конфига: {result}")
+    return result
+
+
+@mqtt_router.route("intercom/{mac}/management/config/refresh", name="config-refresh", schema=EmptyCommand,
+                   concurrency=2)
+async def handle_config_refresh(client, command: EmptyCommand, mac: str):
+    path = state.config_paths.get(mac)
+    if path is None or mac not in state.door_phones:
+        raise KeyError(mac)
+    data = await asyncio.to_thread(config_loader.read_config, path)
+    if not is_valid_config(data) or data["mac"] != mac:
+        raise ValueError(f"Файл {Path(path).name} имеет неверный формат")
+    if "scheduled_keys" in data:
+        data["scheduled_keys"] = schedules.normalize(data["scheduled_keys"])
+    state.seed_config_version(mac, data.pop("version", 0))
+    if mac in state.provision_dirty:
+        # Несохранённые дельты новее файла
+        data = state.previous_configs[mac]
+    old_config = state.previous_configs.get(mac)
+    changed = data != old_config
+    if changed:
+        state.set_access(mac, data["location"], data["allowed_keys"], data["apartments"], data.get("scheduled_keys"))
+        state.previous_configs[mac] = data
+        state.bump_config_version(mac)
+    # Неизменённый конфиг переопубликуется тем же событием modified: retained-топик читают сверка
+    # при старте и внешние потребители, других событий они не знают
+    await publisher.publish(client, f"intercom/{mac}/config",
+                            payload=config_event(mac, "modified", new_config=data,
+                                                 old_config=old_config if old_config is not None else data),
+                            kind="config", retain=True)
+    logger.info(f"{mac} - конфиг обновлён по команде, изменения: {changed}")
+    return {"changed": changed}
 
-                async for message in client.messages:
-                    try:
-                        my_topic = message.topic
-                        my_payload = json.loads(message.payload)
-                        logger.info(f"New MQTT management message: topic={message.topic}, payload={my_payload}")
-                        current_mac = str(my_topic).split("/")[1]
 
-                        sender = 'management-service'
-                        event = my_payload.get("event")
+@mqtt_router.route("intercom/{mac}/management/close", name="close", schema=CloseCommand, concurrency=32)
+async def handle_close(client, command: CloseCommand, mac: str):
+    return await functions.close_door(mac, f"{command.reason} - management-service")
 
-                        if event == "call-response":
-                            response_event = state.call_event(current_mac)
-                            response_event["response_event"].set()
-                            logger.info(f"{current_mac} - Получено сообщение от открытии")
 
-                        await functions.open_door(current_mac, management_message=f'{event} - {sender}')
-                        _ = asyncio.create_task(functions.auto_close_door(current_mac))
+@mqtt_router.route("intercom/{mac}/management/status", name="status", schema=EmptyCommand, concurrency=64)
+async def handle_status(client, command: EmptyCommand, mac: str):
+    door = state.door_phones[mac]
+    return {"door_status": door["door_status"],
+            "version": door.get("door_version", 0),
+            "config_version": state.config_versions.get(mac, 0),
+            "call_status": state.call_results.get(mac, "waiting")}
 
+
+# Команды открытия двери перечислены явно: опечатка в топике не должна открывать дверь
+@mqtt_router.route("intercom/{mac}/management/door", name="open", schema=DoorCommand, concurrency=32)
+@mqtt_router.route("intercom/{mac}/management/open", name="open", schema=DoorCommand, concurrency=32)
+@mqtt_router.route("intercom/{mac}/management/call-response", name="open", schema=DoorCommand, concurrency=32)
+async def handle_open(client, command: DoorCommand, mac: str):
+    sender = 'management-service'
+    if command.event == "call-response":
+        response_event = state.call_event(mac)
+        response_event["response_event"].set()
+        logger.info(f"{mac} - Получено сообщение от открытии")
+
+    result = await functions.open_door(mac, management_message=f'{command.event} - {sender}')
+    spawn_background(functions.auto_close_door(mac))
+    return result
+
+
+@mqtt_router.route("intercom/{mac}/management/#", name="unknown")
+async def handle_unknown(client, payload, mac: str):
+    raise ValueError("Неизвестная команда management-сервиса")
+
+
+async def listen_for_messages():
+    subscriber.warn_if_default_id()
+    while True:
+        try:
+            async with Client("mqtt", **subscriber.client_options()) as client:
+                # QoS 1 в постоянной сессии: команды, пришедшие во время обрыва, брокер доставит после переподключения
+                await client.subscribe("intercom/+/management/#", qos=1)
+                subscriber.stats.connected()
+                subscriber.backoff.reset()
+
+                async for message in client.messages:
+                    try:
+                        my_payload = publisher.decode(message.payload, message.properties)
+                        logger.info(f"New MQTT management message: topic={message.topic}, payload={my_payload}")
+                        # Команды выполняются параллельно, лимиты - у каждого обработчика
+                        spawn_background(mqtt_router.dispatch(client, str(message.topic), my_payload,
+                                                              message.properties))
                     except Exception as e:
                         logger.error(f"Ошибка при обработке MQTT-сообщения: {e}")
+            subscriber.stats.disconnected()
         except Exception as e:
-            logger.error(f"Ошибка при подписке на MQTT: {e}")
-            await asyncio.sleep(5)
+            subscriber.stats.disconnected(e)
+            delay = subscriber.backoff.next_delay()
+            logger.error(f"Ошибка при подписке на MQTT: {e}, переподключение через {delay:.1f} с")
+            await asyncio.sleep(delay)
             logger.info("MQTT: пробуем переподключиться...")
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(admission.AdmissionMiddleware)
 templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+templates.env.globals["static_url"] = static_assets.url
+app.mount("/static", static_assets.PrecompressedStaticFiles(directory="static"), name="static")
+app.include_router(admission.router)
+app.include_router(commands.router)
+app.include_router(fleet.router)
 app.include_router(functions.router)
+app.include_router(journal.router)
+app.include_router(monitoring.router)
+app.include_router(provisioning.router)
+app.include_router(subscriber.router)
 
 
 @app.get("/")
@@ -188,5 +524,28 @@ async def main(request: Request, error_message: Optional[str] = None,
     )
 
 
+def run_server():
+    if settings.SERVER_MODE != "production":
+        uvicorn.run("main:app", port=settings.SERVER_PORT, reload=True, host=settings.SERVER_HOST)
+        return
+
+    if settings.SERVER_WORKERS > 1:
+        # У каждого воркера был бы свой lifespan: свои check_intercom, send_life и подписчик,
+        # каждая команда выполнялась бы N раз, а состояние дверей и звонков делилось бы по процессам
+        logger.error(f"SERVER_WORKERS={settings.SERVER_WORKERS} не поддерживается: состояние дверей хранится "
+                     f"в памяти процесса, запускается один воркер")
+    uvicorn.run("main:app",
+                host=settings.SERVER_HOST,
+                port=settings.SERVER_PORT,
+                workers=1,
+                loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+                http="httptools" if importlib.util.find_spec("httptools") else "h11",
+                backlog=settings.SERVER_BACKLOG,
+                timeout_keep_alive=settings.SERVER_KEEP_ALIVE,
+                timeout_graceful_shutdown=settings.SERVER_DRAIN_TIMEOUT + 5,
+                access_log=settings.SERVER_ACCESS_LOG,
+                proxy_headers=True)
+
+
 if __name__ == '__main__':
-    uvicorn.run("main:app", port=8000, reload=True, host='0.0.0.0')
+    run_server()
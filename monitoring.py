@@ -0,0 +1,152 @@
+# monitoring.py
+
+# Мониторинг event loop: задержка цикла, поиск блокирующих колбэков со снятием стека
+# и сэмплирующий профайлер по запросу. Всё включается через LOOP_MONITOR_ENABLED -
+# при выключенном мониторинге не создаются ни задачи, ни потоки.
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+
+from fastapi import APIRouter, HTTPException, Query
+from starlette.responses import PlainTextResponse
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+loop_thread_id = None
+last_tick = 0.0
+lag_samples = deque(maxlen=600)  # последние задержки цикла, секунды
+lag_max = 0.0
+slow_callbacks = deque(maxlen=20)
+
+_watchdog_stop = None
+_profile_lock = threading.Lock()
+
+
+def tick_interval() -> float:
+    # Отметки цикла чаще порога блокировки: иначе блокировка, начавшаяся сразу после отметки
+    # и закончившаяся до следующей, не видна ни сторожу, ни замеру задержки
+    return min(settings.LOOP_MONITOR_INTERVAL, settings.LOOP_SLOW_CALLBACK_SECONDS / 2)
+
+
+async def sample_loop_lag():
+    global last_tick, lag_max
+    tick = tick_interval()
+    window_started, window_lag = time.monotonic(), 0.0
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(tick)
+        now = time.monotonic()
+        lag = max(0.0, now - started - tick)
+        last_tick = now
+        window_lag = max(window_lag, lag)
+        lag_max = max(lag_max, lag)
+        # В выборку идёт максимальная задержка за LOOP_MONITOR_INTERVAL
+        if now - window_started >= settings.LOOP_MONITOR_INTERVAL:
+            lag_samples.append(window_lag)
+            window_started, window_lag = now, 0.0
+
+
+def frame_stack(frame) -> list[str]:
+    return [f"{entry.name} ({entry.filename}:{entry.lineno})" for entry in traceback.extract_stack(frame)]
+
+
+def _watchdog(stop: threading.Event):
+    # Отдельный поток: если event loop не отмечался дольше порога - снимаем его стек
+    threshold = settings.LOOP_SLOW_CALLBACK_SECONDS
+    tick = tick_interval()
+    stalled = False
+    while not stop.wait(threshold / 4):
+        blocked_for = time.monotonic() - last_tick - tick
+        if blocked_for < threshold:
+            stalled = False
+            continue
+        if stalled:
+            continue
+        stalled = True
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            continue
+        stack = frame_stack(frame)
+        slow_callbacks.append({"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                               "blocked_for": round(blocked_for, 3),
+                               "stack": stack})
+        logger.warning(f"Event loop заблокирован на {blocked_for:.3f} с: {stack[-1] if stack else '?'}")
+
+
+def start() -> list[asyncio.Task]:
+    global loop_thread_id, last_tick, _watchdog_stop
+    if not settings.LOOP_MONITOR_ENABLED:
+        return []
+    loop_thread_id = threading.get_ident()
+    last_tick = time.monotonic()
+    _watchdog_stop = threading.Event()
+    threading.Thread(target=_watchdog, args=(_watchdog_stop,), name="loop-watchdog", daemon=True).start()
+    return [asyncio.create_task(sample_loop_lag())]
+
+
+def stop():
+    global _watchdog_stop
+    if _watchdog_stop is not None:
+        _watchdog_stop.set()
+        _watchdog_stop = None
+
+
+def collect_profile(seconds: float, interval: float) -> Counter:
+    # Сэмплирование стека потока event loop, результат - collapsed stacks для flamegraph
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is not None:
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def loop_stats() -> dict:
+    samples = sorted(lag_samples)
+    if not samples:
+        return {"samples": 0}
+    return {"samples": len(samples),
+            "last": round(lag_samples[-1], 4),
+            "p50": round(samples[len(samples) // 2], 4),
+            "p99": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 4),
+            "max": round(lag_max, 4)}
+
+
+def _check_enabled():
+    if not settings.LOOP_MONITOR_ENABLED or loop_thread_id is None:
+        raise HTTPException(status_code=404, detail="Мониторинг event loop отключен")
+
+
+@router.get("/debug/loop")
+async def debug_loop():
+    _check_enabled()
+    return {"lag": loop_stats(), "slow_callbacks": list(slow_callbacks)}
+
+
+@router.get("/debug/profile")
+async def debug_profile(seconds: float = Query(5, gt=0, le=60), interval: float = Query(0.005, ge=0.001, le=1)):
+    _check_enabled()
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Профилирование уже запущено")
+    try:
+        stacks = await asyncio.to_thread(collect_profile, seconds, interval)
+    finally:
+        _profile_lock.release()
+    return PlainTextResponse("\n".join(f"{stack} {count}" for stack, count in stacks.most_common()))
@@ -0,0 +1,202 @@
+# provisioning.py
+
+# Точечное добавление и удаление ключей и квартир без перезаписи всего конфига.
+# Изменения сразу применяются к state, публикуются как дельта с номером версии
+# и пачками сохраняются в YAML-файлы домофонов.
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+import yaml
+from aiomqtt import Client
+from fastapi import APIRouter, Body, HTTPException, Path
+
+import publisher
+import settings
+import state
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+DELTA_FIELDS = ("add_keys", "remove_keys", "add_apartments", "remove_apartments")
+
+
+def parse_delta(data) -> dict:
+    if not isinstance(data, dict):
+        raise ValueError("Дельта должна быть объектом")
+    delta = {}
+    for field in DELTA_FIELDS:
+        values = data.get(field, [])
+        if not isinstance(values, list) or not all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+            raise ValueError(f"Поле {field} должно быть списком целых чисел")
+        delta[field] = set(values)
+    return delta
+
+
+async def apply_delta(mac: str, data, client=None) -> dict:
+    delta = parse_delta(data)
+    if mac not in state.door_phones:
+        raise KeyError(mac)
+
+    entry = state.door_phones[mac]
+    keys = set(entry["allowed_keys"])
+    apartments = set(entry["apartments"])
+    scheduled = state.scheduled_keys(mac)
+    # В событие попадает только реально изменившееся; удаление ключа снимает и его расписания
+    applied = {
+        "add_keys": delta["add_keys"] - keys,
+        "remove_keys": delta["remove_keys"] & (keys | {window["key"] for window in scheduled}),
+        "add_apartments": delta["add_apartments"] - apartments,
+        "remove_apartments": delta["remove_apartments"] & apartments,
+    }
+    if not any(applied.values()):
+        return {"version": state.config_versions.get(mac, 0), "changed": False}
+
+    scheduled = [window for window in scheduled if window["key"] not in applied["remove_keys"]]
+    state.set_access(mac, entry["location"],
+                     (keys | applied["add_keys"]) - applied["remove_keys"],
+                     (apartments | applied["add_apartments"]) - applied["remove_apartments"],
+                     scheduled)
+    entry = state.door_phones[mac]
+    config = {**state.previous_configs.get(mac, {}),
+              "mac": mac,
+              "location": entry["location"],
+              "allowed_keys": sorted(entry["allowed_keys"]),
+              "apartments": sorted(entry["apartments"])}
+    if scheduled or "scheduled_keys" in config:
+        config["scheduled_keys"] = scheduled
+    version = commit_config(mac, config)
+    logger.info(f"{mac} - применена дельта конфига, версия {version}")
+    await publish_delta(mac, version, {field: sorted(values) for field, values in applied.items() if values}, client)
+    return {"version": version, "changed": True}
+
+
+def commit_config(mac: str, config: dict) -> int:
+    # Новая версия конфига: файл перезапишет flush, номер версии уходит в дельте
+    state.previous_configs[mac] = config
+    state.provision_dirty.add(mac)
+    return state.bump_config_version(mac)
+
+
+async def publish_delta(mac: str, version: int, changes: dict, client=None):
+    payload = {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "event": "delta",
+               "version": version,
+               **changes}
+    try:
+        if client is not None:
+            await publisher.publish(client, f"intercom/{mac}/config/delta", payload=payload, kind="config")
+        else:
+            async with Client("mqtt", **publisher.client_options()) as client:
+                await publisher.publish(client, f"intercom/{mac}/config/delta", payload=payload, kind="config")
+    except Exception as e:
+        logger.error(f"{mac} - не удалось отправить дельту конфига: {e}")
+
+
+async def revoke_keys(keys) -> dict:
+    # Отзыв ключей со всех домофонов парка: домофоны находятся по обратному индексу,
+    # дельты отправляются через одно соединение
+    keys = parse_delta({"remove_keys": keys})["remove_keys"]
+    targets = {}
+    for key in keys:
+        for mac in state.key_index.get(key, ()):
+            targets.setdefault(mac, set()).add(key)
+    if not targets:
+        return {}
+    results = {}
+    try:
+        async with Client("mqtt", **publisher.client_options()) as client:
+            for mac, mac_keys in sorted(targets.items()):
+                results[mac] = await apply_delta(mac, {"remove_keys": sorted(mac_keys)}, client)
+    except Exception as e:
+        logger.error(f"Ошибка соединения с MQTT при отзыве ключей: {e}")
+    # Без брокера ключи всё равно отзываются локально, дельты публикуются по одной
+    for mac, mac_keys in sorted(targets.items()):
+        if mac not in results and mac in state.door_phones:
+            results[mac] = await apply_delta(mac, {"remove_keys": sorted(mac_keys)})
+    logger.info(f"Ключи {sorted(keys)} отозваны на {len(results)} домофонах")
+    return results
+
+
+def write_config(path, config: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True, sort_keys=False, default_flow_style=None)
+    os.replace(tmp_path, path)
+
+
+async def flush():
+    for mac in list(state.provision_dirty):
+        path = state.config_paths.get(mac)
+        config = state.previous_configs.get(mac)
+        if path is None or config is None:
+            state.provision_dirty.discard(mac)
+            continue
+        version = state.config_versions.get(mac, 0)
+        await asyncio.to_thread(write_config, path, {**config, "version": version} if version else config)
+        # Если за время записи пришла новая дельта - файл запишется в следующий раз
+        if state.previous_configs.get(mac) is config:
+            state.provision_dirty.discard(mac)
+        logger.info(f"{mac} - конфиг сохранён в {path}")
+
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(settings.PROVISION_FLUSH_INTERVAL)
+        try:
+            await flush()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения конфигов: {e}")
+
+
+async def purge_expired_keys(now: datetime | None = None) -> dict:
+    # Окна ключей с истёкшим сроком убираются из индекса и из конфига: как и любая дельта,
+    # это новая версия конфига, дельты всех домофонов отправляются через одно соединение
+    now = now or datetime.now()
+    purged = {}
+    for mac, index in list(state.schedule_index.items()):
+        if index.next_expiry is None or index.next_expiry > now or mac not in state.door_phones:
+            continue
+        active = index.active_entries(now)
+        removed = [window for window in index.entries if window not in active]
+        entry = state.door_phones[mac]
+        # Ключ с другим действующим окном или из allowed_keys доступ не теряет
+        remaining = {window["key"] for window in active} | set(entry["allowed_keys"])
+        expired = sorted({window["key"] for window in removed} - remaining)
+        state.set_access(mac, entry["location"], entry["allowed_keys"], entry["apartments"], active)
+        version = state.config_versions.get(mac, 0)
+        if mac in state.previous_configs:
+            version = commit_config(mac, {**state.previous_configs[mac], "scheduled_keys": active})
+        purged[mac] = (version, {"expired_keys": expired, "expired_windows": removed})
+        logger.info(f"{mac} - удалено просроченных окон ключей: {len(index.entries) - len(active)}, версия {version}")
+    if not purged:
+        return {}
+    try:
+        async with Client("mqtt", **publisher.client_options()) as client:
+            for mac, (version, changes) in purged.items():
+                await publish_delta(mac, version, changes, client)
+    except Exception as e:
+        logger.error(f"Ошибка соединения с MQTT при удалении просроченных ключей: {e}")
+    return {mac: version for mac, (version, _) in purged.items()}
+
+
+async def purge_periodically():
+    while True:
+        await asyncio.sleep(settings.SCHEDULE_PURGE_INTERVAL)
+        try:
+            await purge_expired_keys()
+        except Exception as e:
+            logger.error(f"Ошибка удаления просроченных ключей: {e}")
+
+
+@router.post("/{current_mac}/provision")
+async def provision(delta: dict = Body(...), current_mac: str = Path(..., min_length=17, max_length=17)):
+    try:
+        return await apply_delta(current_mac, delta)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Домофон не найден")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
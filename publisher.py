@@ -0,0 +1,160 @@
+# publisher.py
+
+import json
+import logging
+import time
+import weakref
+
+from aiomqtt import ProtocolVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "cbor": "application/cbor",
+}
+
+# Алиасы топиков действуют только в пределах одного соединения,
+# поэтому храним их отдельно для каждого клиента
+_topic_aliases = weakref.WeakKeyDictionary()
+_unavailable_warned = set()
+# Время последней публикации по каждому домофону (time.monotonic)
+_last_activity = {}
+
+
+def is_v5() -> bool:
+    return settings.MQTT_PROTOCOL == ProtocolVersion.V5
+
+
+def client_options() -> dict:
+    if is_v5():
+        return {"protocol": ProtocolVersion.V5}
+    return {}
+
+
+def qos_for(kind: str) -> int:
+    if kind == "life":
+        return settings.MQTT_LIFE_QOS
+    if kind == "config":
+        return settings.MQTT_CONFIG_QOS
+    return settings.MQTT_EVENT_QOS
+
+
+def _apply_alias(client, topic: str, properties: Properties) -> str:
+    if settings.MQTT_TOPIC_ALIAS_MAX <= 0:
+        return topic
+    aliases = _topic_aliases.setdefault(client, {})
+    alias = aliases.get(topic)
+    if alias is not None:
+        # Топик уже привязан к алиасу - отправляем пустой топик
+        properties.TopicAlias = alias
+        return ""
+    if len(aliases) < settings.MQTT_TOPIC_ALIAS_MAX:
+        aliases[topic] = len(aliases) + 1
+        properties.TopicAlias = aliases[topic]
+    return topic
+
+
+def encoding_for(topic: str) -> str:
+    # Семейство топика - сегмент после mac (intercom/{mac}/config/delta - config),
+    # у остальных топиков - последний сегмент
+    parts = topic.split("/")
+    family = parts[2] if len(parts) >= 3 and parts[0] == "intercom" else parts[-1]
+    encoding = settings.MQTT_ENCODINGS.get(family, "json")
+    if encoding == "msgpack" and msgpack is None or encoding == "cbor" and cbor2 is None:
+        if encoding not in _unavailable_warned:
+            _unavailable_warned.add(encoding)
+            logger.warning(f"Кодирование {encoding} недоступно (не установлен пакет), используется json")
+        return "json"
+    return encoding
+
+
+def encode(data, encoding: str = "json"):
+    if encoding == "msgpack":
+        return msgpack.packb(data)
+    if encoding == "cbor":
+        return cbor2.dumps(data)
+    return json.dumps(data)
+
+
+def detect_encoding(payload, content_type=None) -> str:
+    for encoding, known_type in CONTENT_TYPES.items():
+        if content_type == known_type:
+            return encoding
+    if isinstance(payload, str) or not payload:
+        return "json"
+    # Без content-type (MQTT 3.1.1) определяем формат по первому байту:
+    # json-объект начинается с "{", map в CBOR - 0xa0-0xbf, map в MessagePack - 0x80-0x8f, 0xde, 0xdf
+    first = payload[0]
+    if 0xa0 <= first <= 0xbf:
+        return "cbor"
+    if 0x80 <= first <= 0x8f or first in (0xde, 0xdf):
+        return "msgpack"
+    return "json"
+
+
+def decode(payload, properties=None):
+    content_type = getattr(properties, "ContentType", None)
+    encoding = detect_encoding(payload, content_type if isinstance(content_type, str) else None)
+    if encoding == "msgpack" and msgpack is not None:
+        return msgpack.unpackb(payload)
+    if encoding == "cbor" and cbor2 is not None:
+        return cbor2.loads(payload)
+    return json.loads(payload)
+
+
+def build_properties(client, topic: str, kind: str, content_type: str | None = None,
+                     correlation_data: bytes | None = None) -> tuple[str, Properties | None]:
+    if not is_v5():
+        return topic, None
+    properties = Properties(PacketTypes.PUBLISH)
+    if content_type:
+        properties.ContentType = content_type
+    if correlation_data:
+        properties.CorrelationData = correlation_data
+    if kind == "life" and settings.MQTT_LIFE_EXPIRY > 0:
+        properties.MessageExpiryInterval = settings.MQTT_LIFE_EXPIRY
+    if kind not in ("config", "reply"):
+        # config публикуется один раз за соединение, а топики ответов задаёт отправитель команды -
+        # алиас для них не даёт выигрыша
+        topic = _apply_alias(client, topic, properties)
+    return topic, properties
+
+
+def last_activity(mac: str) -> float | None:
+    return _last_activity.get(mac)
+
+
+async def publish(client, topic: str, payload, kind: str = "event", retain: bool = False,
+                  correlation_data: bytes | None = None):
+    parts = topic.split("/")
+    if len(parts) >= 3 and parts[0] == "intercom":
+        _last_activity[parts[1]] = time.monotonic()
+    content_type = None
+    if not isinstance(payload, (str, bytes)):
+        encoding = encoding_for(topic)
+        payload = encode(payload, encoding)
+        if encoding != "json":
+            content_type = CONTENT_TYPES[encoding]
+    topic, properties = build_properties(client, topic, kind, content_type, correlation_data)
+    options = {"payload": payload, "qos": qos_for(kind)}
+    if retain:
+        options["retain"] = True
+    if properties is not None:
+        options["properties"] = properties
+    await client.publish(topic, **options)
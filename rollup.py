@@ -0,0 +1,130 @@
+# rollup.py
+
+# Агрегация событий домофонов по окнам: вместо (или вместе с) отдельными событиями
+# в intercom/{mac}/message раз в ROLLUP_WINDOW секунд публикуется одно сообщение
+# intercom/{mac}/rollup со счётчиками открытий по источникам, неверных ключей,
+# звонков по результатам и длительностью открытого состояния двери.
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from aiomqtt import Client
+
+import publisher
+import settings
+
+logger = logging.getLogger(__name__)
+
+# mac -> счётчики текущего окна
+window = {}
+window_started = datetime.now()
+# mac -> time.monotonic() открытия двери, живёт дольше окна
+_opened_at = {}
+
+
+def _counters(mac: str) -> dict:
+    counters = window.get(mac)
+    if counters is None:
+        counters = window[mac] = {"opens": {}, "failed_keys": 0, "calls": {}, "closes": 0,
+                                  "open_count": 0, "open_sum": 0.0, "open_max": 0.0}
+    return counters
+
+
+def _increment(counter: dict, name: str):
+    counter[name] = counter.get(name, 0) + 1
+
+
+def open_source(event: str) -> str:
+    # Команды management-сервиса приходят как "<событие> - management-service",
+    # источник определяется по событию до " - "
+    name = event.split(" - ", 1)[0]
+    if name == "key":
+        return "key"
+    if name == "call-response":
+        return "call"
+    return "management"
+
+
+def merge(target: dict, counters: dict):
+    for field in ("opens", "calls"):
+        for name, count in counters[field].items():
+            target[field][name] = target[field].get(name, 0) + count
+    for field in ("failed_keys", "closes", "open_count", "open_sum"):
+        target[field] += counters[field]
+    target["open_max"] = max(target["open_max"], counters["open_max"])
+
+
+def record(mac: str, payload: dict):
+    event = str(payload.get("event", ""))
+    success = payload.get("status") == "success"
+    counters = _counters(mac)
+
+    if event == "call-start":
+        _increment(counters["calls"], "started" if success else "rejected")
+    elif event == "call-end":
+        _increment(counters["calls"], str(payload.get("result", "unknown")))
+    elif event == "key" and not success:
+        counters["failed_keys"] += 1
+    elif success and payload.get("door_status") == "open":
+        _increment(counters["opens"], open_source(event))
+        _opened_at[mac] = time.monotonic()
+    elif success and payload.get("door_status") == "closed":
+        counters["closes"] += 1
+        opened_at = _opened_at.pop(mac, None)
+        if opened_at is not None:
+            duration = time.monotonic() - opened_at
+            counters["open_count"] += 1
+            counters["open_sum"] += duration
+            counters["open_max"] = max(counters["open_max"], duration)
+
+
+def aggregate(counters: dict, started: datetime, seconds: float) -> dict:
+    # В сообщение попадают только ненулевые счётчики
+    message = {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "window_start": started.strftime("%Y-%m-%d %H:%M:%S"),
+               "window": seconds}
+    if counters["opens"]:
+        message["opens"] = counters["opens"]
+    if counters["failed_keys"]:
+        message["failed_keys"] = counters["failed_keys"]
+    if counters["calls"]:
+        message["calls"] = counters["calls"]
+    if counters["closes"]:
+        message["closes"] = counters["closes"]
+    if counters["open_count"]:
+        message["door_open"] = {"count": counters["open_count"],
+                                "avg": round(counters["open_sum"] / counters["open_count"], 3),
+                                "max": round(counters["open_max"], 3)}
+    return message
+
+
+async def flush():
+    global window, window_started
+    current, started = window, window_started
+    window, window_started = {}, datetime.now()
+    if not current:
+        return
+    seconds = round((window_started - started).total_seconds(), 3)
+    sent = set()
+    try:
+        async with Client("mqtt", **publisher.client_options()) as client:
+            for mac, counters in current.items():
+                await publisher.publish(client, f"intercom/{mac}/rollup", payload=aggregate(counters, started, seconds))
+                sent.add(mac)
+    except Exception as e:
+        # Неотправленные счётчики возвращаются в текущее окно и уйдут со следующим
+        logger.error(f"Не удалось отправить агрегаты событий: {e}")
+        for mac, counters in current.items():
+            if mac not in sent:
+                merge(_counters(mac), counters)
+        window_started = started
+        return
+    logger.info(f"Отправлены агрегаты событий по {len(current)} домофонам")
+
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(settings.ROLLUP_WINDOW)
+        await flush()
@@ -0,0 +1,189 @@
+# schedules.py
+
+# Ключи с расписанием (scheduled_keys в конфиге домофона):
+#   - key: 555              # уборщица: по будням с 7 до 11
+#     weekdays: [1, 2, 3, 4, 5]
+#     time: "07:00-11:00"
+#   - key: 777              # курьер: только один день
+#     from: "2025-07-01"
+#     until: "2025-07-01"
+# weekdays - ISO (1 - понедельник), time может переходить через полночь ("22:00-06:00"):
+# такое окно относится к дню начала, часы после полуночи действуют уже на следующий день,
+# from/until - дата или дата и время, дата в until включается целиком.
+#
+# Для проверки при нажатии ключа окна заранее группируются по ключу, и для каждого ключа
+# считается маска из 168 часов недели: вне этих часов ключ отклоняется одной битовой операцией,
+# точная проверка дат и минут выполняется только для окон этого ключа.
+
+from datetime import date, datetime, time, timedelta
+
+HOURS_IN_WEEK = 7 * 24
+
+
+def parse_moment(value, end: bool = False) -> datetime:
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            raise ValueError(f"Дата должна быть в местном времени без часового пояса: {value!r}")
+        return value
+    if isinstance(value, date):
+        moment = datetime.combine(value, time())
+        return moment + timedelta(days=1) if end else moment
+    if isinstance(value, str):
+        moment = datetime.fromisoformat(value)
+        if end and len(value.strip()) == 10:
+            moment += timedelta(days=1)
+        return parse_moment(moment)
+    raise ValueError(f"Неверная дата: {value!r}")
+
+
+def parse_minutes(value: str) -> int:
+    hours, minutes = value.strip().split(":")
+    hours, minutes = int(hours), int(minutes)
+    if not (0 <= hours <= 24 and 0 <= minutes < 60 and hours * 60 + minutes <= 24 * 60):
+        raise ValueError(f"Неверное время: {value!r}")
+    return hours * 60 + minutes
+
+
+class Window:
+    __slots__ = ("key", "start", "end", "weekdays", "minutes")
+
+    def __init__(self, entry: dict):
+        if not isinstance(entry, dict):
+            raise ValueError("Окно ключа должно быть объектом")
+        key = entry.get("key")
+        if not isinstance(key, int) or isinstance(key, bool):
+            raise ValueError("key должен быть целым числом")
+        self.key = key
+        self.start = parse_moment(entry["from"]) if entry.get("from") is not None else None
+        self.end = parse_moment(entry["until"], end=True) if entry.get("until") is not None else None
+        if self.start and self.end and self.start >= self.end:
+            raise ValueError(f"Пустой период действия ключа {key}")
+
+        weekdays = entry.get("weekdays")
+        if weekdays is None:
+            self.weekdays = None
+        else:
+            if not isinstance(weekdays, list) or not all(isinstance(d, int) and 1 <= d <= 7 for d in weekdays):
+                raise ValueError("weekdays - список дней недели от 1 до 7")
+            self.weekdays = frozenset(d - 1 for d in weekdays)
+
+        span = entry.get("time")
+        if span is None:
+            self.minutes = None
+        else:
+            if not isinstance(span, str) or "-" not in span:
+                raise ValueError("time - интервал вида HH:MM-HH:MM")
+            begin, finish = span.split("-", 1)
+            self.minutes = (parse_minutes(begin), parse_minutes(finish))
+            if self.minutes[0] == self.minutes[1]:
+                raise ValueError(f"Пустой интервал времени ключа {key}")
+
+    def contains(self, now: datetime) -> bool:
+        if self.start is not None and now < self.start:
+            return False
+        if self.end is not None and now >= self.end:
+            return False
+        day = now.weekday()
+        if self.minutes is not None:
+            minute = now.hour * 60 + now.minute
+            begin, finish = self.minutes
+            if begin < finish:
+                if not begin <= minute < finish:
+                    return False
+            elif minute < finish:
+                # После полуночи действует окно, начавшееся накануне
+                day = (day - 1) % 7
+            elif minute < begin:
+                return False
+        return self.weekdays is None or day in self.weekdays
+
+    def hours(self) -> list[int]:
+        # Часы суток, которые пересекаются с интервалом time
+        return self.day_hours() + self.next_day_hours()
+
+    def day_hours(self) -> list[int]:
+        # Часы в день начала окна
+        if self.minutes is None:
+            return list(range(24))
+        begin, finish = self.minutes
+        if begin < finish:
+            return list(range(begin // 60, (finish - 1) // 60 + 1))
+        return list(range(begin // 60, 24))
+
+    def next_day_hours(self) -> list[int]:
+        # Часы после полуночи у окна, переходящего через полночь
+        if self.minutes is None or self.minutes[0] < self.minutes[1]:
+            return []
+        finish = self.minutes[1]
+        return list(range(0, (finish - 1) // 60 + 1 if finish else 0))
+
+    def week_mask(self) -> int:
+        # Битовая маска 168 часов недели (бит day * 24 + hour), в которые окно может действовать
+        day_mask = next_day_mask = 0
+        for hour in self.day_hours():
+            day_mask |= 1 << hour
+        for hour in self.next_day_hours():
+            next_day_mask |= 1 << hour
+        days = self.weekdays if self.weekdays is not None else range(7)
+        mask = 0
+        for day in days:
+            mask |= day_mask << (day * 24) | next_day_mask << ((day + 1) % 7 * 24)
+        return mask
+
+
+def normalize(entries: list[dict]) -> list[dict]:
+    # YAML разбирает даты в date/datetime - приводим к строкам, чтобы конфиг сериализовался
+    # и сравнивался с retained-версией из брокера
+    result = []
+    for entry in entries:
+        entry = dict(entry)
+        for field in ("from", "until"):
+            value = entry.get(field)
+            if isinstance(value, datetime):
+                entry[field] = value.isoformat(sep=" ")
+            elif isinstance(value, date):
+                entry[field] = value.isoformat()
+        result.append(entry)
+    return result
+
+
+def is_valid(entries) -> bool:
+    if not isinstance(entries, list):
+        return False
+    try:
+        for entry in entries:
+            Window(entry)
+    except (ValueError, TypeError, KeyError):
+        return False
+    return True
+
+
+class ScheduleIndex:
+    def __init__(self, entries: list[dict]):
+        self.entries = entries
+        self.windows = [Window(entry) for entry in entries]
+        # key -> (маска часов недели по всем окнам ключа, окна ключа)
+        self.by_key = {}
+        for window in self.windows:
+            mask, windows = self.by_key.get(window.key, (0, []))
+            windows.append(window)
+            self.by_key[window.key] = (mask | window.week_mask(), windows)
+        ends = [window.end for window in self.windows if window.end is not None]
+        self.next_expiry = min(ends) if ends else None
+
+    def keys(self) -> set[int]:
+        return set(self.by_key)
+
+    def allows(self, key: int, now: datetime) -> bool:
+        found = self.by_key.get(key)
+        if found is None:
+            return False
+        mask, windows = found
+        if not mask >> (now.weekday() * 24 + now.hour) & 1:
+            return False
+        return any(window.contains(now) for window in windows)
+
+    def active_entries(self, now: datetime) -> list[dict]:
+        # Конфиг без окон, срок действия которых уже закончился
+        return [entry for entry, window in zip(self.entries, self.windows)
+                if window.end is None or window.end > now]
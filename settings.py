@@ -0,0 +1,106 @@
+# settings.py
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Профиль MQTT: "compat" - MQTT 3.1.1 и QoS 1 для всего (как раньше),
+# "efficient" - MQTT v5, алиасы топиков, expiry для life и QoS 0 для heartbeat
+MQTT_PROFILE = os.getenv("MQTT_PROFILE", "compat")
+_efficient = MQTT_PROFILE == "efficient"
+
+MQTT_PROTOCOL = env_int("MQTT_PROTOCOL", 5 if _efficient else 4)  # 4 - MQTT 3.1.1, 5 - MQTT v5
+MQTT_EVENT_QOS = env_int("MQTT_EVENT_QOS", 1)
+MQTT_CONFIG_QOS = env_int("MQTT_CONFIG_QOS", 1)
+MQTT_LIFE_QOS = env_int("MQTT_LIFE_QOS", 0 if _efficient else 1)
+MQTT_LIFE_EXPIRY = env_int("MQTT_LIFE_EXPIRY", 20 if _efficient else 0)  # секунды, 0 - без expiry
+MQTT_TOPIC_ALIAS_MAX = env_int("MQTT_TOPIC_ALIAS_MAX", 10 if _efficient else 0)  # 0 - без алиасов
+
+# Кодирование payload по семействам топиков: json (по умолчанию), msgpack или cbor
+MQTT_ENCODINGS = {
+    "message": os.getenv("MQTT_ENCODING_MESSAGE", "json"),
+    "life": os.getenv("MQTT_ENCODING_LIFE", "json"),
+    "config": os.getenv("MQTT_ENCODING_CONFIG", "json"),
+}
+
+# Сводный heartbeat: один пакет со списком online-домофонов вместо life-сообщения от каждого
+MQTT_LIFE_DIGEST = env_bool("MQTT_LIFE_DIGEST")
+MQTT_LIFE_DIGEST_TOPIC = os.getenv("MQTT_LIFE_DIGEST_TOPIC", "intercom-fleet/life")
+# Индивидуальный life в режиме digest шлётся, если от домофона не было сообщений дольше этого времени (секунды)
+MQTT_LIFE_DIGEST_KEEPALIVE = env_int("MQTT_LIFE_DIGEST_KEEPALIVE", 300)
+
+# Локальный журнал событий двери
+JOURNAL_ENABLED = env_bool("JOURNAL_ENABLED")
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal")
+JOURNAL_SEGMENT_BYTES = env_int("JOURNAL_SEGMENT_BYTES", 4 * 1024 * 1024)
+JOURNAL_INDEX_INTERVAL = env_int("JOURNAL_INDEX_INTERVAL", 64)  # шаг разреженного индекса по времени, записей
+JOURNAL_RETENTION_SECONDS = env_int("JOURNAL_RETENTION_SECONDS", 30 * 24 * 3600)
+JOURNAL_COMPACT_INTERVAL = env_int("JOURNAL_COMPACT_INTERVAL", 3600)  # секунды
+JOURNAL_FSYNC = env_bool("JOURNAL_FSYNC")
+
+# Мониторинг event loop и профайлер (/debug/loop, /debug/profile)
+LOOP_MONITOR_ENABLED = env_bool("LOOP_MONITOR_ENABLED")
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL") or 0.5)  # период замера задержки, секунды
+LOOP_SLOW_CALLBACK_SECONDS = float(os.getenv("LOOP_SLOW_CALLBACK_SECONDS") or 0.1)  # порог блокировки, секунды
+
+# Загрузка конфигов домофонов
+CONFIG_IO_THREADS = env_int("CONFIG_IO_THREADS", 4)
+CONFIG_PROCESS_THRESHOLD = env_int("CONFIG_PROCESS_THRESHOLD", 500)  # с какого числа файлов разбирать в процессах
+CONFIG_PROCESS_CHUNK = env_int("CONFIG_PROCESS_CHUNK", 250)
+CONFIG_PARSE_PROCESSES = env_int("CONFIG_PARSE_PROCESSES", 0)  # 0 - по числу CPU
+
+# Сверка с retained-конфигами в брокере при старте
+CONFIG_RECONCILE = env_bool("CONFIG_RECONCILE", True)
+CONFIG_RECONCILE_TIMEOUT = float(os.getenv("CONFIG_RECONCILE_TIMEOUT") or 10)  # общий лимит, секунды
+CONFIG_RECONCILE_IDLE = float(os.getenv("CONFIG_RECONCILE_IDLE") or 1)  # пауза без сообщений = retained закончились
+CONFIG_SNAPSHOT_FILE = os.getenv("CONFIG_SNAPSHOT_FILE", "")  # снимок опубликованных конфигов, если брокер недоступен
+
+# Период сохранения дельт ключей и квартир в YAML-файлы, секунды
+PROVISION_FLUSH_INTERVAL = env_int("PROVISION_FLUSH_INTERVAL", 5)
+# Период удаления ключей с истёкшим сроком действия (scheduled_keys), секунды
+SCHEDULE_PURGE_INTERVAL = env_int("SCHEDULE_PURGE_INTERVAL", 600)
+
+# Агрегаты событий по окнам в intercom/{mac}/rollup
+ROLLUP_ENABLED = env_bool("ROLLUP_ENABLED")
+ROLLUP_WINDOW = env_int("ROLLUP_WINDOW", 60)  # секунды
+ROLLUP_RAW_EVENTS = env_bool("ROLLUP_RAW_EVENTS", True)  # продолжать отправлять отдельные события
+
+# Подписка на команды management-сервиса: постоянная сессия и переподключение
+MQTT_CLIENT_ID = os.getenv("MQTT_CLIENT_ID", "")  # по умолчанию intercom-service-<hostname>
+MQTT_SESSION_EXPIRY = env_int("MQTT_SESSION_EXPIRY", 3600)  # сколько брокер хранит сессию (MQTT v5), секунды
+MQTT_RECONNECT_BASE = float(os.getenv("MQTT_RECONNECT_BASE") or 0.5)  # секунды
+MQTT_RECONNECT_MAX = float(os.getenv("MQTT_RECONNECT_MAX") or 30)
+
+# Ответы на команды management-сервиса
+COMMAND_REPLY_TOPIC = os.getenv("COMMAND_REPLY_TOPIC", "intercom/{mac}/response")  # если reply_to не указан
+COMMAND_DEDUP_SIZE = env_int("COMMAND_DEDUP_SIZE", 10000)
+COMMAND_DEDUP_TTL = env_int("COMMAND_DEDUP_TTL", 600)  # сколько помнить выполненные correlation_id, секунды
+
+# Контроль допуска HTTP-запросов: приоритет действий с дверью над статусами и страницами
+ADMISSION_CONCURRENCY = env_int("ADMISSION_CONCURRENCY", 64)  # запросов в обработке, 0 - без ограничения
+ADMISSION_QUEUE_SIZE = env_int("ADMISSION_QUEUE_SIZE", 256)
+ADMISSION_QUEUE_TIMEOUT_DOOR = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_DOOR") or 5)  # секунды
+ADMISSION_QUEUE_TIMEOUT_STATUS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_STATUS") or 0.5)
+ADMISSION_QUEUE_TIMEOUT_UI = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_UI") or 1)
+ADMISSION_RETRY_AFTER = env_int("ADMISSION_RETRY_AFTER", 1)  # секунды
+
+# Запуск сервера: dev - uvicorn с reload (как раньше), production - без reload, uvloop/httptools
+SERVER_MODE = os.getenv("SERVER_MODE", "dev")
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = env_int("SERVER_PORT", 8000)
+SERVER_WORKERS = env_int("SERVER_WORKERS", 1)
+SERVER_BACKLOG = env_int("SERVER_BACKLOG", 2048)
+SERVER_KEEP_ALIVE = env_int("SERVER_KEEP_ALIVE", 30)  # секунды
+SERVER_ACCESS_LOG = env_bool("SERVER_ACCESS_LOG", SERVER_MODE != "production")
+SERVER_DRAIN_TIMEOUT = env_int("SERVER_DRAIN_TIMEOUT", 15)  # ожидание фоновых задач при остановке, секунды
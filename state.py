@@ -1,29 +1,140 @@
 # state.py
 
 import asyncio
+from datetime import datetime
+
+import schedules
 
 door_phones = {}
 previous_configs = {}
+# Конфиги загружены хотя бы один раз после старта
+configs_loaded = False
+# mac -> путь к YAML-файлу домофона
+config_paths = {}
+# Версии конфигов и домофоны с ещё не сохранёнными в файл дельтами. Версия сохраняется в YAML-файл
+# при записи дельт и в retained-события конфига, после перезапуска берётся наибольшая из них
+config_versions = {}
+provision_dirty = set()
+
+# Сводный heartbeat: номер последнего пакета и домофоны, о которых уже отправлен life
+life_digest_seq = 0
+life_reported = set()
+
+
+# Обратные индексы по парку: ключ, квартира и адрес -> множество MAC
+key_index = {}
+apartment_index = {}
+address_index = {}
+# mac -> schedules.ScheduleIndex для ключей с расписанием
+schedule_index = {}
+
+
+def address_of(location: str) -> str:
+    # Адрес дома - location без подъезда: "Ул. Пушкина, 1, Подъезд 1" -> "ул. пушкина, 1"
+    parts = [part.strip() for part in location.split(",")]
+    return ", ".join(part for part in parts if part and not part.lower().startswith("подъезд")).lower()
+
+
+def _reindex(index: dict, mac: str, old: set, new: set):
+    for value in old - new:
+        macs = index.get(value)
+        if macs is not None:
+            macs.discard(mac)
+            if not macs:
+                del index[value]
+    for value in new - old:
+        index.setdefault(value, set()).add(mac)
+
+
+def scheduled_keys(mac: str) -> list[dict]:
+    index = schedule_index.get(mac)
+    return index.entries if index is not None else []
+
+
+def set_access(mac: str, location: str, allowed_keys, apartments, scheduled=None):
+    # Обновление записи домофона вместе с индексами: в индексах меняется только разница
+    current = door_phones.get(mac, {})
+    old_index = schedule_index.get(mac)
+    scheduled = list(scheduled or [])
+    if scheduled != scheduled_keys(mac):
+        # Индекс расписаний перестраивается только для домофона, у которого оно изменилось
+        if scheduled:
+            schedule_index[mac] = schedules.ScheduleIndex(scheduled)
+        else:
+            schedule_index.pop(mac, None)
+    new_index = schedule_index.get(mac)
+
+    new_keys = set(allowed_keys)
+    new_apartments = set(apartments)
+    old_all_keys = current.get("allowed_keys", set()) | (old_index.keys() if old_index else set())
+    _reindex(key_index, mac, old_all_keys, new_keys | (new_index.keys() if new_index else set()))
+    _reindex(apartment_index, mac, current.get("apartments", set()), new_apartments)
+    old_address = {address_of(current["location"])} if "location" in current else set()
+    _reindex(address_index, mac, old_address, {address_of(location)})
+    door_phones[mac] = {
+        "location": location,
+        "allowed_keys": new_keys,
+        "apartments": new_apartments,
+        "door_status": current.get("door_status", "closed"),
+        "door_version": current.get("door_version", 0)
+    }
+
+
+def remove_doorphone(mac: str):
+    current = door_phones.pop(mac, None)
+    if current is None:
+        return
+    index = schedule_index.pop(mac, None)
+    _reindex(key_index, mac, current.get("allowed_keys", set()) | (index.keys() if index else set()), set())
+    _reindex(apartment_index, mac, current.get("apartments", set()), set())
+    if "location" in current:
+        _reindex(address_index, mac, {address_of(current["location"])}, set())
+
+
+def key_allowed(mac: str, key: int, now: datetime | None = None) -> bool:
+    if key in door_phones[mac]["allowed_keys"]:
+        return True
+    index = schedule_index.get(mac)
+    return index is not None and index.allows(key, now or datetime.now())
+
+
+def bump_config_version(mac: str) -> int:
+    version = config_versions.get(mac, 0) + 1
+    config_versions[mac] = version
+    return version
+
+
+def seed_config_version(mac: str, version):
+    if isinstance(version, int) and not isinstance(version, bool) and version > config_versions.get(mac, 0):
+        config_versions[mac] = version
 
 
 def update_doorphones(new_configs: list[dict]):
     existing_macs = set(door_phones.keys())
     new_macs = set(cfg["mac"] for cfg in new_configs)
 
-    # Добавляем новые
+    # Добавляем новые и обновляем изменённые (статус двери сохраняется)
     for cfg in new_configs:
-        mac = cfg["mac"]
-        if mac not in door_phones:
-            door_phones[mac] = {
-                "location": cfg["location"],
-                "allowed_keys": cfg["allowed_keys"],
-                "apartments": cfg["apartments"],
-                "door_status": "closed"
-            }
+        set_access(cfg["mac"], cfg["location"], cfg["allowed_keys"], cfg["apartments"], cfg.get("scheduled_keys"))
 
     # Удаляем отсутствующие
     for mac in existing_macs - new_macs:
-        del door_phones[mac]
+        remove_doorphone(mac)
+
+
+# Состояние дверей: текущее открытие (future с результатом) и версия, для которой запущен таймер закрытия
+door_opening = {}
+close_timers = {}
+
+
+def door_transition(mac: str, expected_version: int, expected_status: str, new_status: str) -> bool:
+    # compare-and-set: переход выполняется, только если дверь не менялась с момента чтения версии
+    door = door_phones.get(mac)
+    if door is None or door.get("door_version", 0) != expected_version or door["door_status"] != expected_status:
+        return False
+    door["door_status"] = new_status
+    door["door_version"] = expected_version + 1
+    return True
 
 
 def get_all_configs():
@@ -0,0 +1,119 @@
+# static_assets.py
+
+# Раздача статики с отпечатками в именах файлов (main.<hash>.css), immutable-кэшированием
+# и заранее сжатыми gzip/brotli-вариантами, которые выбираются по Accept-Encoding.
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+# Имя файла -> URL с отпечатком, заполняется при создании PrecompressedStaticFiles
+_urls = {}
+
+
+def url(name: str) -> str:
+    return _urls.get(name, f"/static/{name}")
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match - список ETag через запятую, сравнение слабое (без W/)
+    for item in if_none_match.split(","):
+        item = item.strip()
+        if item == "*" or item.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class Asset:
+    def __init__(self, data: bytes, media_type: str, digest: str):
+        self.media_type = media_type
+        self.digest = digest
+        self.variants = {"identity": data}
+        if media_type.startswith(COMPRESSIBLE_TYPES):
+            # Сжатый вариант храним, только если он действительно меньше
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data):
+                self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants["br"] = compressed
+
+    def choose(self, accept_encoding: str) -> str:
+        accepted = accepted_encodings(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def __init__(self, *, directory, prefix: str = "/static"):
+        super().__init__(directory=directory)
+        self.assets = {}
+        self.immutable = set()
+        root = Path(directory)
+        for path in sorted(root.rglob("*")):
+            if not path.is_file():
+                continue
+            name = path.relative_to(root).as_posix()
+            data = path.read_bytes()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            asset = Asset(data, media_type, digest)
+            fingerprinted = str(Path(name).with_name(f"{path.stem}.{digest}{path.suffix}").as_posix())
+            self.assets[name] = asset
+            self.assets[fingerprinted] = asset
+            self.immutable.add(fingerprinted)
+            _urls[name] = f"{prefix}/{fingerprinted}"
+        logger.info(f"Статика подготовлена: {len(_urls)} файлов")
+
+    async def get_response(self, path: str, scope) -> Response:
+        asset = self.assets.get(path)
+        if asset is None or scope["method"] not in ("GET", "HEAD"):
+            # Остальные методы StaticFiles отклоняет с 405
+            return await super().get_response(path, scope)
+
+        request_headers = Headers(scope=scope)
+        encoding = asset.choose(request_headers.get("accept-encoding", ""))
+        etag = f'"{asset.digest}-{encoding}"'
+        headers = {"Cache-Control": IMMUTABLE if path in self.immutable else REVALIDATE,
+                   "Vary": "Accept-Encoding",
+                   "ETag": etag}
+        if etag_matches(request_headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(asset.variants[encoding], media_type=asset.media_type, headers=headers)
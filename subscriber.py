@@ -0,0 +1,108 @@
+# subscriber.py
+
+# Постоянная сессия подписчика на команды management-сервиса: стабильный client id,
+# сессия не очищается при переподключении (clean_session=False или Session Expiry в MQTT v5),
+# поэтому брокер хранит QoS 1 команды, пришедшие пока сервис был отключён.
+# Переподключение - с экспоненциальной задержкой и случайным разбросом, чтобы экземпляры
+# не переподключались к перезапущенному брокеру одновременно.
+# Client id должен переживать пересборку контейнера: hostname контейнера без явного hostname
+# случаен, поэтому в docker-compose MQTT_CLIENT_ID задан явно.
+
+import logging
+import random
+import socket
+import time
+
+from fastapi import APIRouter
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+import publisher
+import settings
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+
+def client_id() -> str:
+    return settings.MQTT_CLIENT_ID or f"intercom-service-{socket.gethostname()}"
+
+
+def warn_if_default_id():
+    if not settings.MQTT_CLIENT_ID:
+        logger.warning(f"MQTT_CLIENT_ID не задан, используется {client_id()}: если hostname меняется "
+                       f"при перезапуске (контейнер без hostname), команды, пришедшие во время перезапуска, теряются")
+
+
+def client_options() -> dict:
+    options = {**publisher.client_options(), "identifier": client_id()}
+    if publisher.is_v5():
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = settings.MQTT_SESSION_EXPIRY
+        options["clean_start"] = False
+        options["properties"] = properties
+    else:
+        options["clean_session"] = False
+    return options
+
+
+class Backoff:
+    # Full jitter: задержка равномерно в [0, min(max_delay, base * 2^attempt)]
+    def __init__(self, base: float, max_delay: float):
+        self.base = base
+        self.max_delay = max_delay
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.connects = 0
+        self.reconnects = 0
+        self.disconnected_at = None  # time.monotonic() момента потери соединения
+        self.downtime_total = 0.0
+        self.downtime_last = 0.0
+        self.last_error = None
+
+    def connected(self):
+        now = time.monotonic()
+        if self.disconnected_at is not None:
+            self.downtime_last = now - self.disconnected_at
+            self.downtime_total += self.downtime_last
+            self.reconnects += 1
+            self.disconnected_at = None
+        self.connects += 1
+
+    def disconnected(self, error: Exception | None = None):
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
+        if error is not None:
+            self.last_error = str(error)
+
+    def snapshot(self) -> dict:
+        down_for = time.monotonic() - self.disconnected_at if self.disconnected_at is not None else 0.0
+        return {"client_id": client_id(),
+                "connected": self.connects > 0 and self.disconnected_at is None,
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "downtime_current": round(down_for, 3),
+                "downtime_last": round(self.downtime_last, 3),
+                "downtime_total": round(self.downtime_total, 3),
+                "last_error": self.last_error}
+
+
+backoff = Backoff(settings.MQTT_RECONNECT_BASE, settings.MQTT_RECONNECT_MAX)
+stats = ConnectionStats()
+
+
+@router.get("/debug/mqtt")
+async def mqtt_stats():
+    return stats.snapshot()
@@ -0,0 +1,94 @@
+import pytest
+import asyncio
+
+from fastapi import FastAPI, BackgroundTasks
+from fastapi.testclient import TestClient
+
+import admission
+import settings
+
+
+def make_controller(limit=1, queue_size=10, timeout=1.0):
+    return admission.AdmissionController(limit, queue_size,
+                                         {admission.DOOR: timeout, admission.STATUS: timeout, admission.UI: timeout})
+
+
+def test_classify():
+    mac = "AA:BB:CC:DD:EE:FF"
+    assert admission.classify("POST", f"/{mac}/open-door-key") == admission.DOOR
+    assert admission.classify("POST", f"/{mac}/call") == admission.DOOR
+    assert admission.classify("GET", f"/{mac}/status") == admission.STATUS
+    assert admission.classify("GET", f"/{mac}/call-status-update") == admission.STATUS
+    assert admission.classify("GET", "/fleet/keys/1") == admission.STATUS
+    assert admission.classify("GET", f"/{mac}") == admission.UI
+    assert admission.classify("GET", "/static/main.css") is None
+
+
+@pytest.mark.asyncio
+async def test_queued_requests_admitted_by_priority():
+    controller = make_controller()
+    assert await controller.acquire(admission.UI)
+
+    order = []
+
+    async def request(priority, name):
+        if await controller.acquire(priority):
+            order.append(name)
+            controller.release()
+
+    tasks = [asyncio.create_task(request(admission.UI, "ui")),
+             asyncio.create_task(request(admission.STATUS, "status")),
+             asyncio.create_task(request(admission.DOOR, "door"))]
+    await asyncio.sleep(0)
+    controller.release()
+    await asyncio.gather(*tasks)
+
+    assert order == ["door", "status", "ui"]
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_shedding_on_full_queue_and_timeout():
+    controller = make_controller(queue_size=1, timeout=0.05)
+    assert await controller.acquire(admission.DOOR)
+
+    ui = asyncio.create_task(controller.acquire(admission.UI))
+    await asyncio.sleep(0)
+    # Очередь заполнена: дверь вытесняет страницу, ещё одна страница сразу отклоняется
+    door = asyncio.create_task(controller.acquire(admission.DOOR))
+    await asyncio.sleep(0)
+    assert await ui is False
+    assert await controller.acquire(admission.UI) is False
+    # Место так и не освободилось - запрос двери отклоняется по времени ожидания
+    assert await door is False
+
+    stats = controller.snapshot()["classes"]
+    assert stats["ui"]["shed_queue_full"] == 2
+    assert stats["door"]["shed_timeout"] == 1
+    assert controller.snapshot()["active"] == 1
+
+
+def test_middleware_returns_503_and_releases_after_response(mocker):
+    controller = make_controller(limit=1, queue_size=0)
+    mocker.patch.object(admission, "controller", controller)
+    mocker.patch.object(settings, "ADMISSION_RETRY_AFTER", 3)
+
+    app = FastAPI()
+    app.add_middleware(admission.AdmissionMiddleware)
+    background_done = []
+
+    @app.get("/{mac}/status")
+    async def status(mac: str, background_tasks: BackgroundTasks):
+        # Фоновая задача выполняется после ответа и не занимает место
+        background_tasks.add_task(lambda: background_done.append(controller.active))
+        return {"door_status": "closed"}
+
+    client = TestClient(app)
+    assert client.get("/mac1/status").status_code == 200
+    assert background_done == [0]
+
+    controller.active = 1
+    response = client.get("/mac1/status")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "3"
+    assert controller.stats["status"]["shed_queue_full"] == 1
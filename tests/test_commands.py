@@ -0,0 +1,101 @@
+import pytest
+import asyncio
+import json
+import time
+from unittest.mock import AsyncMock
+
+import commands
+import settings
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(mocker):
+    mocker.patch.object(commands, "dedup", commands.DedupCache(100, 60))
+    mocker.patch.object(commands, "latency", {"handling": {}, "e2e": {}})
+    mocker.patch.object(commands, "duplicates", 0)
+    mocker.patch.object(commands, "_in_flight", {})
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 4)
+
+
+def test_dedup_cache_bounded_by_size_and_ttl(mocker):
+    now = [1000.0]
+    mocker.patch("commands.time.monotonic", side_effect=lambda: now[0])
+    cache = commands.DedupCache(max_size=2, ttl=10)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("c", 3)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+
+    now[0] += 11
+    assert cache.get("c") is None
+    assert len(cache) == 0
+
+
+def test_reply_target(mocker):
+    mocker.patch.object(settings, "COMMAND_REPLY_TOPIC", "intercom/{mac}/response")
+
+    assert commands.reply_target("mac1", {}) == (None, None)
+    assert commands.reply_target("mac1", {"correlation_id": "c1"}) == ("c1", "intercom/mac1/response")
+    assert commands.reply_target("mac1", {"correlation_id": "c1", "reply_to": "svc/replies"}) == ("c1", "svc/replies")
+    # Ответ в топик команд зациклил бы сервис
+    assert commands.reply_target("mac1", {"reply_to": "intercom/mac1/management/door"}) == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_execute_replies_and_deduplicates_retries():
+    client = AsyncMock()
+    handler = AsyncMock(return_value={"door_status": "open"})
+    payload = {"event": "open", "correlation_id": "c1", "reply_to": "svc/replies", "sent_at": time.time()}
+
+    first = await commands.execute(client, "mac1", "open", payload, handler)
+    retry = await commands.execute(client, "mac1", "open", payload, handler)
+
+    handler.assert_awaited_once()
+    assert retry is first
+    assert first["status"] == "ok"
+    assert first["result"] == {"door_status": "open"}
+    assert first["correlation_id"] == "c1"
+    assert client.publish.await_count == 2
+    topic = client.publish.call_args.args[0]
+    assert topic == "svc/replies"
+    assert json.loads(client.publish.call_args.kwargs["payload"])["correlation_id"] == "c1"
+
+    stats = await commands.command_stats()
+    assert stats["duplicates"] == 1
+    assert stats["latency"]["handling"]["open"]["count"] == 1
+    assert stats["latency"]["e2e"]["open"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_execute_retry_waits_for_in_flight_command():
+    client = AsyncMock()
+    release = asyncio.Event()
+
+    async def slow_handler():
+        await release.wait()
+        return "done"
+    handler = AsyncMock(side_effect=slow_handler)
+    payload = {"correlation_id": "c2"}
+
+    first = asyncio.create_task(commands.execute(client, "mac1", "open", payload, handler))
+    await asyncio.sleep(0)
+    retry = asyncio.create_task(commands.execute(client, "mac1", "open", payload, handler))
+    await asyncio.sleep(0)
+    release.set()
+
+    first_result, retry_result = await asyncio.gather(first, retry)
+    handler.assert_awaited_once()
+    assert first_result is retry_result
+
+
+@pytest.mark.asyncio
+async def test_execute_reports_errors_without_correlation():
+    client = AsyncMock()
+
+    response = await commands.execute(client, "mac1", "provision", {}, AsyncMock(side_effect=KeyError("mac1")))
+
+    assert response["status"] == "error"
+    assert response["correlation_id"] is None
+    client.publish.assert_not_awaited()
@@ -0,0 +1,37 @@
+import pytest
+import yaml
+
+import config_loader
+import settings
+
+
+@pytest.fixture
+def doorphones_dir(tmp_path):
+    door_dir = tmp_path / "doorphones"
+    door_dir.mkdir()
+    for i in range(6):
+        config = {"mac": f"mac{i}", "location": "street", "allowed_keys": [i], "apartments": [i]}
+        (door_dir / f"{i}.yml").write_text(yaml.safe_dump(config), encoding="utf-8")
+    (door_dir / "notes.txt").write_text("not a config", encoding="utf-8")
+    yield door_dir
+    config_loader.shutdown()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("threshold", [1000, 2])
+async def test_load_configs_threads_and_processes(mocker, doorphones_dir, threshold):
+    mocker.patch.object(settings, "CONFIG_PROCESS_THRESHOLD", threshold)
+    mocker.patch.object(settings, "CONFIG_PROCESS_CHUNK", 4)
+
+    result = await config_loader.load_configs(str(doorphones_dir))
+
+    assert [path.name for path, _ in result] == [f"{i}.yml" for i in range(6)]
+    assert [data["mac"] for _, data in result] == [f"mac{i}" for i in range(6)]
+
+
+@pytest.mark.asyncio
+async def test_load_configs_raises_on_broken_yaml(doorphones_dir):
+    (doorphones_dir / "9.yml").write_text("mac: [", encoding="utf-8")
+
+    with pytest.raises(yaml.YAMLError):
+        await config_loader.load_configs(str(doorphones_dir))
@@ -0,0 +1,65 @@
+import pytest
+import json
+from unittest.mock import AsyncMock
+
+from fastapi.testclient import TestClient
+
+import state
+from main import app
+
+CONFIGS = [
+    {"mac": "AA:AA:AA:AA:AA:01", "location": "Ул. Пушкина, 1, Подъезд 1", "allowed_keys": [111, 23234],
+     "apartments": [1, 25]},
+    {"mac": "AA:AA:AA:AA:AA:02", "location": "Ул. Пушкина, 1, Подъезд 2", "allowed_keys": [23234],
+     "apartments": [25, 26]},
+    {"mac": "AA:AA:AA:AA:AA:03", "location": "Ул. Ленина, 5, Подъезд 1", "allowed_keys": [222],
+     "apartments": [25]},
+]
+
+
+@pytest.fixture
+def fleet(mocker):
+    mocker.patch.object(state, "door_phones", {})
+    mocker.patch.object(state, "key_index", {})
+    mocker.patch.object(state, "apartment_index", {})
+    mocker.patch.object(state, "address_index", {})
+    mocker.patch.object(state, "previous_configs", {cfg["mac"]: cfg for cfg in CONFIGS})
+    mocker.patch.object(state, "config_versions", {})
+    mocker.patch.object(state, "provision_dirty", set())
+    state.update_doorphones(CONFIGS)
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("provisioning.Client", return_value=mock_client)
+    return mock_client
+
+
+def test_fleet_queries(fleet):
+    client = TestClient(app)
+
+    assert client.get("/fleet/keys/23234").json() == {"key": 23234,
+                                                      "macs": ["AA:AA:AA:AA:AA:01", "AA:AA:AA:AA:AA:02"]}
+    response = client.get("/fleet/apartments/25", params={"address": "ул. Пушкина,  1"})
+    assert response.json()["macs"] == ["AA:AA:AA:AA:AA:01", "AA:AA:AA:AA:AA:02"]
+    assert len(client.get("/fleet/apartments/25").json()["macs"]) == 3
+    assert client.get("/fleet/addresses").json() == {"ул. ленина, 5": ["AA:AA:AA:AA:AA:03"],
+                                                     "ул. пушкина, 1": ["AA:AA:AA:AA:AA:01", "AA:AA:AA:AA:AA:02"]}
+
+
+def test_fleet_bulk_revoke(fleet):
+    client = TestClient(app)
+
+    response = client.post("/fleet/keys/revoke", json={"keys": [23234]})
+
+    assert response.status_code == 200
+    assert set(response.json()["revoked"]) == {"AA:AA:AA:AA:AA:01", "AA:AA:AA:AA:AA:02"}
+    assert state.key_index.get(23234) is None
+    assert state.door_phones["AA:AA:AA:AA:AA:01"]["allowed_keys"] == {111}
+    assert state.previous_configs["AA:AA:AA:AA:AA:02"]["allowed_keys"] == []
+    # Обе дельты ушли через одно соединение
+    assert fleet.__aenter__.await_count == 1
+    topics = [call.args[0] for call in fleet.publish.call_args_list]
+    assert topics == ["intercom/AA:AA:AA:AA:AA:01/config/delta", "intercom/AA:AA:AA:AA:AA:02/config/delta"]
+    assert json.loads(fleet.publish.call_args.kwargs["payload"])["remove_keys"] == [23234]
+
+    assert client.post("/fleet/keys/revoke", json={"keys": ["x"]}).status_code == 400
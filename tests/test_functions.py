@@ -343,3 +343,61 @@ async def test_call_wait_response_variants(monkeypatch, mocker, done_key, expect
     assert data["status"] == "success"
     assert data["result"] == expected_result
     assert data["door_status"] == "closed"
+
+
+@pytest.mark.asyncio
+async def test_open_door_coalesces_concurrent_requests(mocker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mocker.patch.object(state, "door_phones", {mac: {"door_status": "closed", "door_version": 0}})
+    mocker.patch.object(state, "door_opening", {})
+
+    publish_started = asyncio.Event()
+    release_publish = asyncio.Event()
+
+    async def slow_publish(current_mac, payload):
+        publish_started.set()
+        await release_publish.wait()
+        return True
+    mock_publish = mocker.patch("functions.publish_message", side_effect=slow_publish)
+
+    first = asyncio.create_task(functions.open_door(mac, code=111))
+    await publish_started.wait()
+    second = asyncio.create_task(functions.open_door(mac, management_message="open - management-service"))
+    await asyncio.sleep(0)
+    release_publish.set()
+    first_result, second_result = await asyncio.gather(first, second)
+
+    assert mock_publish.await_count == 1
+    assert first_result == {"door_status": "open", "version": 1, "published": True, "coalesced": False}
+    assert second_result == {**first_result, "coalesced": True}
+
+    # Дверь уже открыта - новый запрос тоже объединяется без публикации
+    third_result = await functions.open_door(mac)
+    assert third_result["coalesced"] is True
+    assert mock_publish.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_auto_close_door_single_timer_per_open(mocker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mocker.patch.object(state, "door_phones", {mac: {"door_status": "open", "door_version": 1}})
+    mocker.patch.object(state, "close_timers", {})
+    mock_publish = mocker.patch("functions.publish_message", new_callable=AsyncMock, return_value=True)
+
+    sleeping = asyncio.Event()
+    release = asyncio.Event()
+
+    # asyncio.sleep подменяется глобально, поэтому синхронизируемся через события
+    async def fake_sleep(seconds):
+        sleeping.set()
+        await release.wait()
+    mocker.patch("functions.asyncio.sleep", fake_sleep)
+
+    timers = [asyncio.create_task(functions.auto_close_door(mac)) for _ in range(3)]
+    await sleeping.wait()
+    release.set()
+    await asyncio.gather(*timers)
+
+    assert mock_publish.await_count == 1
+    assert state.door_phones[mac] == {"door_status": "closed", "door_version": 2}
+    assert state.close_timers == {}
@@ -0,0 +1,146 @@
+import pytest
+from unittest.mock import AsyncMock
+
+from fastapi.testclient import TestClient
+
+import functions
+import journal
+import settings
+
+
+@pytest.fixture
+def small_segments(mocker):
+    mocker.patch.object(settings, "JOURNAL_SEGMENT_BYTES", 400)
+    mocker.patch.object(settings, "JOURNAL_INDEX_INTERVAL", 2)
+    mocker.patch.object(settings, "JOURNAL_RETENTION_SECONDS", 100)
+
+
+def fill(j, count):
+    for i in range(count):
+        mac = "mac1" if i % 2 == 0 else "mac2"
+        j.append(mac, f"intercom/{mac}/message", {"event": "key", "n": i}, published=i != 3, ts=1000 + i)
+
+
+def test_journal_query_pagination_and_indexes(tmp_path, small_segments):
+    j = journal.Journal(tmp_path)
+    fill(j, 20)
+
+    assert len(j.segments) > 1
+
+    items, cursor = j.query(limit=7)
+    assert [item["payload"]["n"] for item in items] == list(range(7))
+    items, cursor = j.query(limit=100, cursor=cursor)
+    assert [item["payload"]["n"] for item in items] == list(range(7, 20))
+    assert cursor is None
+
+    items, _ = j.query(mac="mac2", since=1005, until=1011)
+    assert [item["payload"]["n"] for item in items] == [5, 7, 9, 11]
+
+    # После перезапуска индексы восстанавливаются из сегментов
+    j.close()
+    reopened = journal.Journal(tmp_path)
+    items, _ = reopened.query(since=1017)
+    assert [item["payload"]["n"] for item in items] == [17, 18, 19]
+    assert list(reopened.pending) == [4]
+    assert reopened.seq == 20
+
+
+def test_journal_truncated_tail_is_dropped(tmp_path, small_segments):
+    j = journal.Journal(tmp_path)
+    fill(j, 2)
+    j.close()
+    segment = j.segments[-1].path
+    segment.write_bytes(segment.read_bytes()[:-5])
+
+    reopened = journal.Journal(tmp_path)
+    items, _ = reopened.query()
+    assert [item["payload"]["n"] for item in items] == [0]
+
+
+@pytest.mark.asyncio
+async def test_journal_replay_and_compaction(tmp_path, small_segments):
+    j = journal.Journal(tmp_path)
+    fill(j, 20)
+
+    assert [record["seq"] for record in j.pending_records()] == [4]
+    j.mark_delivered([4])
+    assert j.pending == {}
+
+    await j.compact(now=1110)
+
+    items, _ = j.query()
+    # Записи старше срока хранения удалены
+    assert items[0]["ts"] >= 1010
+    assert [item["payload"]["n"] for item in items][-1] == 19
+
+    j.close()
+    reopened = journal.Journal(tmp_path)
+    assert reopened.pending == {}
+    assert len(reopened.query(limit=1000)[0]) == len(items)
+
+
+@pytest.mark.asyncio
+async def test_journal_compaction_skips_unchanged_segments(tmp_path, small_segments, mocker):
+    j = journal.Journal(tmp_path)
+    fill(j, 20)
+    await j.compact(now=1050)
+    segments = list(j.segments)
+
+    # Повторное сжатие без истёкших и доставленных записей файлы не переписывает
+    replace = mocker.patch("journal.os.replace")
+    await j.compact(now=1050)
+    replace.assert_not_called()
+    assert j.segments == segments
+    assert [record["seq"] for record in j.pending_records()] == [4]
+
+    # Доставленное событие переносится в сегмент, остальные сегменты остаются прежними
+    mocker.stop(replace)
+    j.mark_delivered([4])
+    await j.compact(now=1050)
+    assert j.segments[1:] == segments[1:]
+    assert j.delivered == set()
+    j.close()
+    assert journal.Journal(tmp_path).pending == {}
+
+
+def test_journal_interrupted_compaction_leftovers_removed(tmp_path, small_segments):
+    j = journal.Journal(tmp_path)
+    fill(j, 20)
+    j.close()
+    first, second = j.segments[0].path, j.segments[1].path
+    # Падение после os.replace: склеенный сегмент уже содержит записи второго
+    first.write_bytes(first.read_bytes() + second.read_bytes())
+
+    reopened = journal.Journal(tmp_path)
+    items, _ = reopened.query(limit=1000)
+    assert [item["seq"] for item in items] == list(range(1, 21))
+    assert not second.exists()
+    assert list(reopened.pending) == [4]
+
+
+@pytest.mark.asyncio
+async def test_publish_message_journals_failed_event(tmp_path, mocker):
+    mocker.patch.object(journal, "current", journal.Journal(tmp_path))
+    mocker.patch("functions.Client", side_effect=Exception("broker down"))
+
+    result = await functions.publish_message("AA:BB:CC:DD:EE:FF", {"event": "auto-close"})
+
+    assert result is False
+    records = journal.current.pending_records()
+    assert records[0]["topic"] == "intercom/AA:BB:CC:DD:EE:FF/message"
+    assert records[0]["payload"] == {"event": "auto-close"}
+
+
+def test_journal_endpoint(tmp_path, mocker):
+    mocker.patch.object(journal, "current", journal.Journal(tmp_path))
+    journal.current.append("mac1", "intercom/mac1/message", {"event": "key"}, published=True, ts=1000)
+    journal.current.append("mac2", "intercom/mac2/message", {"event": "call-start"}, published=True, ts=1001)
+
+    from main import app
+    client = TestClient(app)
+    response = client.get("/journal", params={"mac": "mac2"})
+
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["payload"]["event"] for item in data["items"]] == ["call-start"]
+    assert data["next_cursor"] is None
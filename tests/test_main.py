@@ -1,6 +1,7 @@
 import pytest
 from unittest.mock import AsyncMock, MagicMock
-from main import send_life, is_valid_config, check_intercom, listen_for_messages, app
+from main import send_life, send_life_digest, is_valid_config, check_intercom, listen_for_messages, app, \
+    load_retained_configs, spawn_background, drain_background_tasks, run_server, mqtt_router
 import json
 import datetime
 
@@ -8,6 +9,10 @@ import yaml
 from pathlib import Path
 
 import asyncio
+import time
+
+import state
+import subscriber
 
 from fastapi.testclient import TestClient
 
@@ -19,6 +24,7 @@ async def test_send_life(mocker):
 
     mocker.patch('main.Client', return_value=mock_client)
     mock_state = mocker.patch('main.state')
+    mock_state.config_versions = {}
     mock_logger = mocker.patch('main.logger')
     mocker.patch('main.asyncio.sleep', side_effect=Exception("stop"))
 
@@ -47,6 +53,29 @@ async def test_send_life(mocker):
     mock_logger.info.assert_any_call("Отправка сигнала о работе: mac1")
 
 
+@pytest.mark.asyncio
+async def test_send_life_digest(mocker):
+    mock_client = AsyncMock()
+    mocker.patch('main.state.door_phones', {'mac1': {}, 'mac2': {}})
+    mocker.patch('main.state.life_digest_seq', 0)
+    mocker.patch('main.state.life_reported', {'mac2', 'old_mac'})
+    mocker.patch('main.settings.MQTT_LIFE_DIGEST_TOPIC', 'intercom-fleet/life')
+    mocker.patch('main.settings.MQTT_LIFE_DIGEST_KEEPALIVE', 300)
+    mocker.patch('main.publisher.last_activity', side_effect=lambda mac: time.monotonic())
+
+    await send_life_digest(mock_client)
+
+    topics = [call.args[0] for call in mock_client.publish.call_args_list]
+    # mac2 уже был в сводке и недавно отправлял сообщения - индивидуальный life не нужен
+    assert topics == ['intercom-fleet/life', 'intercom/mac1/life']
+
+    digest = json.loads(mock_client.publish.call_args_list[0].kwargs["payload"])
+    assert digest["seq"] == 1
+    assert digest["online"] == ['mac1', 'mac2']
+
+    assert state.life_reported == {'mac1', 'mac2'}
+
+
 def test_is_valid_config_true():
     true_data = {"mac": "12", "location": "street", "allowed_keys": [1, 5, 6], "apartments": [15, 20]}
     response = is_valid_config(true_data)
@@ -59,6 +88,13 @@ def test_is_valid_config_false_1():
     assert response is False
 
 
+def test_is_valid_config_scheduled_keys():
+    data = {"mac": "mac1", "location": "loc", "allowed_keys": [1], "apartments": [1],
+            "scheduled_keys": [{"key": 5, "weekdays": [1, 2], "time": "07:00-11:00"}]}
+    assert is_valid_config(data) is True
+    assert is_valid_config({**data, "scheduled_keys": [{"key": 5, "time": "7-11"}]}) is False
+
+
 def test_is_valid_config_false_2():
     false_data = {"mac": "12", "location": "street", "allowed_keys": "1, 5, 6", "apartments": [15, 20]}
     response = is_valid_config(false_data)
@@ -74,6 +110,7 @@ async def test_check_intercom_add(tmp_path, mocker):
     file_path.write_text(yaml.safe_dump(config), encoding="utf-8")
 
     mock_state = mocker.patch('main.state')
+    mock_state.config_versions = {}
 
     mock_state.previous_configs = {}
 
@@ -108,6 +145,7 @@ async def test_check_intercom_deletion(tmp_path, mocker):
     door_dir.mkdir()
 
     mock_state = mocker.patch('main.state')
+    mock_state.config_versions = {}
 
     existing_config = {"location": "street", "allowed_keys": [1, 5, 6], "apartments": [15, 20]}
     mock_state.previous_configs = {"12": existing_config}
@@ -157,6 +195,7 @@ async def test_check_intercom_modified(tmp_path, mocker):
 
     old_config = {"mac": "12", "location": "old_street", "allowed_keys": [1, 5, 6], "apartments": [15, 20]}
     mock_state = mocker.patch('main.state')
+    mock_state.config_versions = {}
     mock_state.previous_configs = {"12": old_config}
 
     mocker.patch.object(
@@ -191,6 +230,187 @@ async def test_check_intercom_modified(tmp_path, mocker):
     assert mock_state.previous_configs == {"12": new_config}
 
 
+def retained_message(topic, payload, retain=True):
+    message = MagicMock()
+    message.topic = topic
+    message.payload = json.dumps(payload).encode()
+    message.retain = retain
+    message.properties = None
+    return message
+
+
+@pytest.mark.asyncio
+async def test_load_retained_configs(mocker):
+    config_a = {"mac": "A", "location": "street", "allowed_keys": [1], "apartments": [1]}
+    config_b = {"mac": "B", "location": "street", "allowed_keys": [2], "apartments": [2]}
+    messages = [
+        retained_message("intercom/A/config", {"event": "added", "new_config": config_a}),
+        retained_message("intercom/B/config", {"event": "modified", "version": 7, "new_config": config_b,
+                                               "old_config": {}}),
+        retained_message("intercom/C/config", {"event": "removed", "old_config": {}}),
+        retained_message("intercom/D/config", {"event": "added", "new_config": {}}, retain=False),
+    ]
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mock_client.messages = AsyncMock()
+    mock_client.messages.__aiter__.return_value = messages
+    mocker.patch("main.Client", return_value=mock_client)
+
+    configs, versions = await load_retained_configs()
+
+    mock_client.subscribe.assert_awaited_once_with("intercom/+/config", qos=1)
+    assert configs == {"A": config_a, "B": config_b}
+    assert versions == {"B": 7}
+
+
+@pytest.mark.asyncio
+async def test_check_intercom_reconciled_start_publishes_only_differences(tmp_path, mocker):
+    door_dir = tmp_path / "doorphones"
+    door_dir.mkdir()
+    same = {"mac": "A", "location": "street", "allowed_keys": [1], "apartments": [1]}
+    changed = {"mac": "B", "location": "street", "allowed_keys": [2, 3], "apartments": [2]}
+    for config in (same, changed):
+        (door_dir / f"{config['mac']}.yml").write_text(yaml.safe_dump(config), encoding="utf-8")
+    files = sorted(door_dir.glob("*.yml"))
+    mocker.patch.object(Path, "glob", lambda self, pattern: files if self == Path("doorphones") else [])
+
+    mocker.patch("main.state.configs_loaded", False)
+    mocker.patch("main.state.previous_configs", {})
+    mocker.patch("main.state.door_phones", {})
+    mocker.patch("main.load_retained_configs", new_callable=AsyncMock,
+                 return_value=({"A": same, "B": {**changed, "allowed_keys": [2]}}, {}))
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("main.Client", return_value=mock_client)
+    mocker.patch("main.asyncio.sleep", side_effect=Exception("stop"))
+
+    with pytest.raises(Exception, match="stop"):
+        await check_intercom()
+
+    assert mock_client.publish.call_count == 1
+    assert mock_client.publish.call_args.args == ("intercom/B/config",)
+    assert json.loads(mock_client.publish.call_args.kwargs["payload"])["event"] == "modified"
+    assert set(state.door_phones) == {"A", "B"}
+    assert state.configs_loaded is True
+
+
+@pytest.mark.asyncio
+async def test_check_intercom_reconcile_ignores_foreign_retained_configs(tmp_path, mocker):
+    door_dir = tmp_path / "doorphones"
+    door_dir.mkdir()
+    own = {"mac": "A", "location": "street", "allowed_keys": [1], "apartments": [1]}
+    (door_dir / "A.yml").write_text(yaml.safe_dump(own), encoding="utf-8")
+    files = sorted(door_dir.glob("*.yml"))
+    mocker.patch.object(Path, "glob", lambda self, pattern: files if self == Path("doorphones") else [])
+
+    # Z - домофон другого экземпляра сервиса, S - удалён из файлов, пока сервис был остановлен
+    snapshot = tmp_path / "snapshot.json"
+    snapshot.write_text(json.dumps({"A": own, "S": {**own, "mac": "S"}}), encoding="utf-8")
+    mocker.patch("main.settings.CONFIG_SNAPSHOT_FILE", str(snapshot))
+    mocker.patch("main.state.configs_loaded", False)
+    mocker.patch("main.state.previous_configs", {})
+    mocker.patch("main.state.door_phones", {})
+    mocker.patch("main.load_retained_configs", new_callable=AsyncMock,
+                 return_value=({"A": own, "S": {**own, "mac": "S"}, "Z": {**own, "mac": "Z"}}, {}))
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("main.Client", return_value=mock_client)
+    mocker.patch("main.asyncio.sleep", side_effect=Exception("stop"))
+
+    with pytest.raises(Exception, match="stop"):
+        await check_intercom()
+
+    topics = [call.args[0] for call in mock_client.publish.call_args_list]
+    assert not any("/Z/" in topic for topic in topics)
+    assert "intercom/S/config" in topics
+    assert set(state.door_phones) == {"A"}
+
+
+@pytest.mark.asyncio
+async def test_check_intercom_keeps_delta_flushed_during_slow_load(tmp_path, mocker):
+    import config_loader
+    import provisioning
+
+    path = tmp_path / "A.yml"
+    config = {"mac": "A", "location": "street", "allowed_keys": [1, 2], "apartments": [1]}
+    path.write_text(yaml.safe_dump(config), encoding="utf-8")
+    mocker.patch("main.state.configs_loaded", True)
+    mocker.patch("main.state.previous_configs", {"A": config})
+    mocker.patch("main.state.door_phones", {})
+    mocker.patch("main.state.key_index", {})
+    mocker.patch("main.state.apartment_index", {})
+    mocker.patch("main.state.address_index", {})
+    mocker.patch("main.state.schedule_index", {})
+    mocker.patch("main.state.config_versions", {})
+    mocker.patch("main.state.provision_dirty", set())
+    mocker.patch("main.state.config_paths", {"A": path})
+    state.update_doorphones([config])
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("main.Client", return_value=mock_client)
+    mocker.patch("provisioning.Client", return_value=mock_client)
+    mocker.patch("main.asyncio.sleep", side_effect=Exception("stop"))
+
+    await provisioning.apply_delta("A", {"remove_keys": [2]})
+    mock_client.publish.reset_mock()
+
+    async def slow_load(directory):
+        # Файл прочитан до записи дельты, flush записывает его и снимает флаг во время загрузки
+        loaded = [(path, config_loader.read_config(path))]
+        await provisioning.flush()
+        return loaded
+
+    mocker.patch("main.config_loader.load_configs", slow_load)
+
+    with pytest.raises(Exception, match="stop"):
+        await check_intercom()
+
+    assert mock_client.publish.call_count == 0
+    assert yaml.safe_load(path.read_text(encoding="utf-8"))["allowed_keys"] == [1]
+    assert state.previous_configs["A"]["allowed_keys"] == [1]
+    assert not state.key_allowed("A", 2)
+
+
+@pytest.mark.asyncio
+async def test_check_intercom_restores_config_version_after_restart(tmp_path, mocker):
+    import provisioning
+
+    door_dir = tmp_path / "doorphones"
+    door_dir.mkdir()
+    config = {"mac": "A", "location": "street", "allowed_keys": [1], "apartments": [1]}
+    # Файл записан flush после дельты версии 5
+    (door_dir / "A.yml").write_text(yaml.safe_dump({**config, "version": 5}), encoding="utf-8")
+    files = sorted(door_dir.glob("*.yml"))
+    mocker.patch.object(Path, "glob", lambda self, pattern: files if self == Path("doorphones") else [])
+
+    mocker.patch("main.settings.CONFIG_SNAPSHOT_FILE", "")
+    mocker.patch("main.state.configs_loaded", False)
+    mocker.patch("main.state.previous_configs", {})
+    mocker.patch("main.state.door_phones", {})
+    mocker.patch("main.state.config_versions", {})
+    mocker.patch("main.state.provision_dirty", set())
+    mocker.patch("main.load_retained_configs", new_callable=AsyncMock, return_value=({"A": config}, {"A": 4}))
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("main.Client", return_value=mock_client)
+    mocker.patch("provisioning.Client", return_value=mock_client)
+    mocker.patch("main.asyncio.sleep", side_effect=Exception("stop"))
+
+    with pytest.raises(Exception, match="stop"):
+        await check_intercom()
+
+    # Конфиг не изменился - ничего не публикуется, версия не откатывается
+    mock_client.publish.assert_not_called()
+    assert state.previous_configs["A"] == config
+    assert state.config_versions["A"] == 5
+    assert (await provisioning.apply_delta("A", {"add_keys": [2]}))["version"] == 6
+
+
 @pytest.mark.asyncio
 async def test_listen_for_messages(mocker):
     mock_message = MagicMock()
@@ -212,10 +432,18 @@ async def test_listen_for_messages(mocker):
 
     mocker.patch("main.asyncio.sleep", side_effect=Exception("stop"))
 
+    mocker.patch("main.subscriber.backoff", subscriber.Backoff(base=0.5, max_delay=30))
+    mocker.patch("main.subscriber.stats", subscriber.ConnectionStats())
+
     with pytest.raises(Exception, match="stop"):
         await listen_for_messages()
+    await drain_background_tasks(1)
 
     assert mock_client.subscribe.call_count == 2
+    mock_client.subscribe.assert_called_with("intercom/+/management/#", qos=1)
+    assert subscriber.stats.connects == 1
+    assert subscriber.stats.last_error == "stop"
+    assert subscriber.backoff.attempt == 1
     mock_call_event.assert_called_once_with("MAC123")
     mock_open_door.assert_awaited_once_with("MAC123", management_message="call-response - management-service")
 
@@ -227,3 +455,102 @@ async def test_root_redirect_no_doorphones(mocker):
     response = client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "Нет доступных домофонов"}
+
+
+@pytest.mark.asyncio
+async def test_drain_background_tasks(mocker):
+    mocker.patch("main.background_tasks", set())
+    finished = []
+
+    async def short():
+        await asyncio.sleep(0)
+        finished.append("short")
+
+    spawn_background(short())
+    long_task = spawn_background(asyncio.sleep(10))
+
+    await drain_background_tasks(0.05)
+    await asyncio.sleep(0)
+
+    assert finished == ["short"]
+    assert long_task.cancelled()
+
+
+@pytest.mark.parametrize("mode, expected", [
+    ("dev", {"reload": True}),
+    # Больше одного воркера не запускается: состояние дверей в памяти процесса
+    ("production", {"workers": 1, "loop": "uvloop", "http": "httptools", "backlog": 2048}),
+])
+def test_run_server_modes(mocker, mode, expected):
+    mocker.patch("main.settings.SERVER_MODE", mode)
+    mocker.patch("main.settings.SERVER_WORKERS", 2)
+    mocker.patch("main.settings.SERVER_BACKLOG", 2048)
+    mocker.patch("main.importlib.util.find_spec", return_value=object())
+    mock_run = mocker.patch("main.uvicorn.run")
+
+    run_server()
+
+    kwargs = mock_run.call_args.kwargs
+    assert mock_run.call_args.args == ("main:app",)
+    assert expected.items() <= kwargs.items()
+    assert "reload" not in kwargs or mode == "dev"
+
+
+@pytest.mark.asyncio
+async def test_mqtt_router_close_and_status_commands(mocker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mocker.patch.object(state, "door_phones", {mac: {"door_status": "open", "door_version": 1}})
+    mocker.patch("main.functions.publish_message", new_callable=AsyncMock, return_value=True)
+    client = AsyncMock()
+
+    closed = await mqtt_router.dispatch(client, f"intercom/{mac}/management/close", {})
+    status = await mqtt_router.dispatch(client, f"intercom/{mac}/management/status", {})
+
+    assert closed["result"] == {"door_status": "closed", "version": 2, "published": True}
+    assert status["result"]["door_status"] == "closed"
+    assert status["result"]["version"] == 2
+
+
+@pytest.mark.asyncio
+async def test_config_refresh_unchanged_keeps_retained_event_known(tmp_path, mocker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    config = {"mac": mac, "location": "street", "allowed_keys": [1], "apartments": [1]}
+    path = tmp_path / "door.yml"
+    path.write_text(yaml.safe_dump(config), encoding="utf-8")
+    mocker.patch.object(state, "config_paths", {mac: path})
+    mocker.patch.object(state, "door_phones", {mac: {"door_status": "closed"}})
+    mocker.patch.object(state, "previous_configs", {mac: config})
+    mocker.patch.object(state, "provision_dirty", set())
+    client = AsyncMock()
+
+    response = await mqtt_router.dispatch(client, f"intercom/{mac}/management/config/refresh", {})
+
+    assert response["result"] == {"changed": False}
+    assert client.publish.call_args.args == (f"intercom/{mac}/config",)
+    assert client.publish.call_args.kwargs["retain"] is True
+    data = json.loads(client.publish.call_args.kwargs["payload"])
+    # Сверка при старте принимает это событие и не объявит домофон заново
+    assert data["event"] == "modified"
+    assert data["new_config"] == config
+
+
+@pytest.mark.asyncio
+async def test_mqtt_router_unknown_command_does_not_open_door(mocker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mock_open_door = mocker.patch("main.functions.open_door", new_callable=AsyncMock, return_value={})
+    mocker.patch("main.functions.auto_close_door", new_callable=AsyncMock)
+    client = AsyncMock()
+
+    for topic in ("status-typo", "config/refersh", "stauts"):
+        response = await mqtt_router.dispatch(client, f"intercom/{mac}/management/{topic}",
+                                              {"event": "door", "correlation_id": topic})
+        assert response["status"] == "error"
+        assert response["command"] == "unknown"
+        assert client.publish.call_args.args == (f"intercom/{mac}/response",)
+    mock_open_door.assert_not_called()
+
+    response = await mqtt_router.dispatch(client, f"intercom/{mac}/management/door", {"event": "door"})
+    assert response["status"] == "ok"
+    mock_open_door.assert_called_once_with(mac, management_message="door - management-service")
+    await drain_background_tasks(1)
+
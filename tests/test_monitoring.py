@@ -0,0 +1,86 @@
+import pytest
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+
+import monitoring
+import settings
+
+
+@pytest.fixture
+def monitor(mocker):
+    mocker.patch.object(settings, "LOOP_MONITOR_ENABLED", True)
+    mocker.patch.object(settings, "LOOP_MONITOR_INTERVAL", 0.01)
+    mocker.patch.object(settings, "LOOP_SLOW_CALLBACK_SECONDS", 0.05)
+    mocker.patch.object(monitoring, "lag_samples", monitoring.deque(maxlen=600))
+    mocker.patch.object(monitoring, "slow_callbacks", monitoring.deque(maxlen=20))
+    mocker.patch.object(monitoring, "loop_thread_id", None)
+    yield
+    monitoring.stop()
+
+
+def test_monitor_disabled_is_noop(mocker):
+    mocker.patch.object(settings, "LOOP_MONITOR_ENABLED", False)
+    mocker.patch.object(monitoring, "loop_thread_id", None)
+    assert monitoring.start() == []
+
+    from main import app
+    client = TestClient(app)
+    assert client.get("/debug/loop").status_code == 404
+
+
+def blocking_call():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_monitor_detects_blocking_callback(monitor):
+    tasks = monitoring.start()
+    await asyncio.sleep(0.05)
+    blocking_call()
+    await asyncio.sleep(0.05)
+    for task in tasks:
+        task.cancel()
+
+    stats = monitoring.loop_stats()
+    assert stats["max"] >= 0.2
+    assert monitoring.slow_callbacks
+    assert any("blocking_call" in frame for frame in monitoring.slow_callbacks[0]["stack"])
+
+
+@pytest.mark.asyncio
+async def test_monitor_default_settings_catch_short_blocks(mocker):
+    # Блокировки короче LOOP_MONITOR_INTERVAL, но дольше порога, между отметками цикла
+    mocker.patch.object(settings, "LOOP_MONITOR_ENABLED", True)
+    mocker.patch.object(settings, "LOOP_MONITOR_INTERVAL", 0.5)
+    mocker.patch.object(settings, "LOOP_SLOW_CALLBACK_SECONDS", 0.1)
+    mocker.patch.object(monitoring, "lag_samples", monitoring.deque(maxlen=600))
+    mocker.patch.object(monitoring, "slow_callbacks", monitoring.deque(maxlen=20))
+    mocker.patch.object(monitoring, "lag_max", 0.0)
+    tasks = monitoring.start()
+    try:
+        for _ in range(3):
+            await asyncio.sleep(0.06)
+            time.sleep(0.35)
+        await asyncio.sleep(0.6)
+    finally:
+        for task in tasks:
+            task.cancel()
+        monitoring.stop()
+
+    assert len(monitoring.slow_callbacks) == 3
+    assert sum(1 for lag in monitoring.lag_samples if lag >= 0.3) >= 2
+    assert monitoring.loop_stats()["max"] >= 0.3
+
+
+@pytest.mark.asyncio
+async def test_collect_profile_collapsed_stacks(monitor):
+    monitoring.start()
+    profile = asyncio.create_task(asyncio.to_thread(monitoring.collect_profile, 0.2, 0.005))
+    await asyncio.sleep(0.02)
+    blocking_call()
+    stacks = await profile
+
+    assert sum(stacks.values()) > 0
+    assert any("blocking_call" in stack and ";" in stack for stack in stacks)
@@ -0,0 +1,103 @@
+import pytest
+import json
+from unittest.mock import AsyncMock
+
+import yaml
+from fastapi.testclient import TestClient
+
+import provisioning
+import state
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+
+@pytest.fixture
+def doorphone(mocker, tmp_path):
+    config = {"mac": MAC, "location": "street", "allowed_keys": [1, 2], "apartments": [10]}
+    path = tmp_path / "door.yml"
+    path.write_text(yaml.safe_dump(config), encoding="utf-8")
+    mocker.patch.object(state, "door_phones", {})
+    mocker.patch.object(state, "previous_configs", {MAC: config})
+    mocker.patch.object(state, "config_paths", {MAC: path})
+    mocker.patch.object(state, "config_versions", {})
+    mocker.patch.object(state, "provision_dirty", set())
+    state.update_doorphones([config])
+
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("provisioning.Client", return_value=mock_client)
+    return path, mock_client
+
+
+@pytest.mark.asyncio
+async def test_apply_delta_publishes_only_changes(doorphone):
+    path, mock_client = doorphone
+
+    result = await provisioning.apply_delta(MAC, {"add_keys": [2, 3], "remove_keys": [1], "add_apartments": [11]})
+
+    assert result == {"version": 1, "changed": True}
+    assert state.door_phones[MAC]["allowed_keys"] == {2, 3}
+    assert state.door_phones[MAC]["apartments"] == {10, 11}
+    assert state.previous_configs[MAC]["allowed_keys"] == [2, 3]
+    assert MAC in state.provision_dirty
+
+    topic, = mock_client.publish.call_args.args
+    assert topic == f"intercom/{MAC}/config/delta"
+    payload = json.loads(mock_client.publish.call_args.kwargs["payload"])
+    assert payload["event"] == "delta"
+    assert payload["version"] == 1
+    assert payload["add_keys"] == [3]
+    assert payload["remove_keys"] == [1]
+    assert payload["add_apartments"] == [11]
+    assert "remove_apartments" not in payload
+
+    # Повторная та же дельта ничего не меняет и не публикуется
+    result = await provisioning.apply_delta(MAC, {"add_keys": [3]})
+    assert result == {"version": 1, "changed": False}
+    assert mock_client.publish.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_apply_delta_validation(doorphone):
+    with pytest.raises(ValueError):
+        await provisioning.apply_delta(MAC, {"add_keys": "5"})
+    with pytest.raises(KeyError):
+        await provisioning.apply_delta("00:00:00:00:00:00", {"add_keys": [5]})
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_yaml(doorphone):
+    path, _ = doorphone
+    await provisioning.apply_delta(MAC, {"add_keys": [7], "remove_apartments": [10]})
+
+    await provisioning.flush()
+
+    assert yaml.safe_load(path.read_text(encoding="utf-8")) == {
+        "mac": MAC, "location": "street", "allowed_keys": [1, 2, 7], "apartments": [], "version": 1}
+    assert state.provision_dirty == set()
+
+
+def test_provision_endpoint(doorphone):
+    from main import app
+    client = TestClient(app)
+
+    response = client.post(f"/{MAC}/provision", json={"add_keys": [5]})
+    assert response.status_code == 200
+    assert response.json() == {"version": 1, "changed": True}
+
+    assert client.post(f"/{MAC}/provision", json={"add_keys": ["x"]}).status_code == 400
+    assert client.post("/00:00:00:00:00:00/provision", json={"add_keys": [5]}).status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_apply_delta_remove_key_drops_its_schedule(doorphone, mocker):
+    mocker.patch.object(state, "schedule_index", {})
+    window = {"key": 9, "weekdays": [6, 7]}
+    state.set_access(MAC, "street", [1, 2], [10], [window, {"key": 8, "time": "08:00-10:00"}])
+
+    result = await provisioning.apply_delta(MAC, {"remove_keys": [9]})
+
+    assert result["changed"] is True
+    assert [entry["key"] for entry in state.scheduled_keys(MAC)] == [8]
+    assert state.previous_configs[MAC]["scheduled_keys"] == [{"key": 8, "time": "08:00-10:00"}]
+    assert state.door_phones[MAC]["allowed_keys"] == {1, 2}
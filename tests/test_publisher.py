@@ -0,0 +1,109 @@
+import pytest
+from unittest.mock import AsyncMock
+
+from aiomqtt import ProtocolVersion
+
+import publisher
+import settings
+
+
+@pytest.mark.asyncio
+async def test_publish_compat_profile(mocker):
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 4)
+    mocker.patch.object(settings, "MQTT_LIFE_QOS", 1)
+    client = AsyncMock()
+
+    await publisher.publish(client, "intercom/mac1/life", payload="{}", kind="life")
+
+    assert publisher.client_options() == {}
+    client.publish.assert_awaited_once_with("intercom/mac1/life", payload="{}", qos=1)
+
+
+@pytest.mark.asyncio
+async def test_publish_efficient_profile_life(mocker):
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 5)
+    mocker.patch.object(settings, "MQTT_LIFE_QOS", 0)
+    mocker.patch.object(settings, "MQTT_LIFE_EXPIRY", 20)
+    mocker.patch.object(settings, "MQTT_TOPIC_ALIAS_MAX", 10)
+    client = AsyncMock()
+
+    await publisher.publish(client, "intercom/mac1/life", payload="{}", kind="life")
+    await publisher.publish(client, "intercom/mac1/life", payload="{}", kind="life")
+
+    assert publisher.client_options() == {"protocol": ProtocolVersion.V5}
+
+    first, second = client.publish.call_args_list
+    assert first.args == ("intercom/mac1/life",)
+    assert first.kwargs["qos"] == 0
+    assert first.kwargs["properties"].MessageExpiryInterval == 20
+    assert first.kwargs["properties"].TopicAlias == 1
+
+    # Повторная публикация в том же соединении идёт по алиасу без топика
+    assert second.args == ("",)
+    assert second.kwargs["properties"].TopicAlias == 1
+
+
+@pytest.mark.asyncio
+async def test_publish_efficient_profile_alias_limit_and_config(mocker):
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 5)
+    mocker.patch.object(settings, "MQTT_EVENT_QOS", 1)
+    mocker.patch.object(settings, "MQTT_TOPIC_ALIAS_MAX", 1)
+    client = AsyncMock()
+
+    await publisher.publish(client, "intercom/mac1/message", payload="{}")
+    await publisher.publish(client, "intercom/mac2/message", payload="{}")
+    await publisher.publish(client, "intercom/mac1/config", payload="{}", kind="config", retain=True)
+
+    first, second, config = client.publish.call_args_list
+    assert first.kwargs["qos"] == 1
+    assert first.kwargs["properties"].TopicAlias == 1
+    assert second.args == ("intercom/mac2/message",)
+    assert not hasattr(second.kwargs["properties"], "TopicAlias")
+    assert config.args == ("intercom/mac1/config",)
+    assert config.kwargs["retain"] is True
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("encoding, content_type", [
+    ("msgpack", "application/msgpack"),
+    ("cbor", "application/cbor"),
+])
+async def test_publish_binary_encoding(mocker, encoding, content_type):
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 5)
+    mocker.patch.object(settings, "MQTT_TOPIC_ALIAS_MAX", 0)
+    mocker.patch.object(settings, "MQTT_ENCODINGS", {"config": encoding})
+    client = AsyncMock()
+    config = {"event": "added", "new_config": {"mac": "mac1", "allowed_keys": list(range(1000))}}
+
+    await publisher.publish(client, "intercom/mac1/config", payload=config, kind="config", retain=True)
+
+    call = client.publish.call_args
+    payload = call.kwargs["payload"]
+    assert isinstance(payload, bytes)
+    assert len(payload) < len(publisher.encode(config))
+    assert call.kwargs["properties"].ContentType == content_type
+    assert publisher.decode(payload, call.kwargs["properties"]) == config
+    # Без content-type (MQTT 3.1.1) формат определяется по первому байту
+    assert publisher.decode(payload) == config
+
+
+@pytest.mark.asyncio
+async def test_publish_default_encoding_is_json(mocker):
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 4)
+    mocker.patch.object(settings, "MQTT_ENCODINGS", {"message": "json"})
+    client = AsyncMock()
+
+    await publisher.publish(client, "intercom/mac1/message", payload={"event": "key"})
+
+    payload = client.publish.call_args.kwargs["payload"]
+    assert payload == '{"event": "key"}'
+    assert publisher.decode(payload) == {"event": "key"}
+    assert publisher.decode(payload.encode()) == {"event": "key"}
+
+
+def test_encoding_family_is_segment_after_mac(mocker):
+    mocker.patch.object(settings, "MQTT_ENCODINGS", {"config": "cbor", "message": "json"})
+    mocker.patch.object(publisher, "cbor2", object())
+    assert publisher.encoding_for("intercom/mac1/config/delta") == "cbor"
+    assert publisher.encoding_for("intercom/mac1/config") == "cbor"
+    assert publisher.encoding_for("intercom/mac1/message") == "json"
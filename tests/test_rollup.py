@@ -0,0 +1,112 @@
+import pytest
+import json
+from unittest.mock import AsyncMock
+
+import functions
+import rollup
+import settings
+
+
+@pytest.fixture(autouse=True)
+def fresh_window(mocker):
+    mocker.patch.object(rollup, "window", {})
+    mocker.patch.object(rollup, "_opened_at", {})
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 4)
+
+
+def test_record_counts_events_by_kind(mocker):
+    now = [100.0]
+    mocker.patch("rollup.time.monotonic", side_effect=lambda: now[0])
+
+    rollup.record("mac1", {"event": "key", "status": "fail", "door_status": "closed"})
+    rollup.record("mac1", {"event": "key", "key": 1, "status": "success", "door_status": "open"})
+    now[0] += 10
+    rollup.record("mac1", {"event": "auto-close", "status": "success", "door_status": "closed"})
+    rollup.record("mac1", {"event": "call-start", "status": "success", "door_status": "closed"})
+    rollup.record("mac1", {"event": "call-start", "status": "fail", "door_status": "closed"})
+    rollup.record("mac1", {"event": "call-end", "status": "success", "result": "timeout", "door_status": "closed"})
+    rollup.record("mac1", {"event": "door - management-service", "status": "success", "door_status": "open"})
+    now[0] += 2
+    rollup.record("mac1", {"event": "forced-close - management-service", "status": "success",
+                           "door_status": "closed"})
+
+    message = rollup.aggregate(rollup.window["mac1"], rollup.window_started, 60)
+    assert message["opens"] == {"key": 1, "management": 1}
+    assert message["failed_keys"] == 1
+    assert message["calls"] == {"started": 1, "rejected": 1, "timeout": 1}
+    assert message["closes"] == 2
+    assert message["door_open"] == {"count": 2, "avg": 6.0, "max": 10.0}
+
+
+@pytest.mark.asyncio
+async def test_flush_publishes_one_message_per_intercom(mocker):
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("rollup.Client", return_value=mock_client)
+
+    for _ in range(3):
+        rollup.record("mac1", {"event": "key", "status": "fail", "door_status": "closed"})
+    rollup.record("mac2", {"event": "call-response", "status": "success", "door_status": "open"})
+    await rollup.flush()
+
+    topics = [call.args[0] for call in mock_client.publish.call_args_list]
+    assert topics == ["intercom/mac1/rollup", "intercom/mac2/rollup"]
+    assert json.loads(mock_client.publish.call_args_list[0].kwargs["payload"])["failed_keys"] == 3
+    assert rollup.window == {}
+
+    await rollup.flush()
+    assert mock_client.publish.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_publish_message_without_raw_events(mocker):
+    mocker.patch.object(settings, "ROLLUP_ENABLED", True)
+    mocker.patch.object(settings, "ROLLUP_RAW_EVENTS", False)
+    mock_client_cls = mocker.patch("functions.Client")
+    mock_journal = mocker.patch("functions.journal.append")
+
+    payload = {"event": "key", "status": "fail", "door_status": "closed"}
+    assert await functions.publish_message("mac1", payload) is True
+
+    mock_client_cls.assert_not_called()
+    mock_journal.assert_called_once_with("mac1", "intercom/mac1/message", payload, published=True)
+    assert rollup.window["mac1"]["failed_keys"] == 1
+
+
+@pytest.mark.asyncio
+async def test_record_call_response_from_open_door(mocker):
+    mac = "AA:BB:CC:DD:EE:FF"
+    mocker.patch.object(settings, "ROLLUP_ENABLED", True)
+    mocker.patch.object(settings, "ROLLUP_RAW_EVENTS", False)
+    mocker.patch("functions.journal.append")
+    mocker.patch.object(functions.state, "door_phones", {mac: {"door_status": "closed", "door_version": 0}})
+    mocker.patch.object(functions.state, "door_opening", {})
+
+    # Такой payload отправляет open_door для команды call-response из main.handle_open
+    await functions.open_door(mac, management_message="call-response - management-service")
+
+    assert rollup.window[mac]["opens"] == {"call": 1}
+
+
+@pytest.mark.asyncio
+async def test_flush_failure_keeps_unsent_counters(mocker):
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mock_client.publish.side_effect = [None, Exception("broker gone")]
+    mocker.patch("rollup.Client", return_value=mock_client)
+
+    rollup.record("mac1", {"event": "key", "status": "fail", "door_status": "closed"})
+    rollup.record("mac2", {"event": "key", "status": "fail", "door_status": "closed"})
+    rollup.record("mac2", {"event": "key", "status": "fail", "door_status": "closed"})
+    started = rollup.window_started
+    await rollup.flush()
+
+    # mac1 уже отправлен, mac2 вернулся в окно
+    assert set(rollup.window) == {"mac2"}
+    assert rollup.window["mac2"]["failed_keys"] == 2
+    assert rollup.window_started == started
+
+    mock_client.publish.side_effect = None
+    rollup.record("mac2", {"event": "key", "status": "fail", "door_status": "closed"})
+    await rollup.flush()
+    assert json.loads(mock_client.publish.call_args.kwargs["payload"])["failed_keys"] == 3
@@ -0,0 +1,143 @@
+import pytest
+import json
+from datetime import date, datetime
+from unittest.mock import AsyncMock
+
+import provisioning
+import schedules
+import state
+
+MONDAY = datetime(2025, 6, 30)
+
+
+def test_window_weekdays_and_time():
+    window = schedules.Window({"key": 1, "weekdays": [1, 2, 3, 4, 5], "time": "07:00-11:00"})
+
+    assert window.contains(MONDAY.replace(hour=7))
+    assert window.contains(MONDAY.replace(hour=10, minute=59))
+    assert not window.contains(MONDAY.replace(hour=11))
+    assert not window.contains(datetime(2025, 7, 5, 8))  # суббота
+    assert window.week_mask() == sum(1 << (day * 24 + hour) for day in range(5) for hour in range(7, 11))
+
+
+def test_window_crossing_midnight_and_dates():
+    night = schedules.Window({"key": 2, "time": "22:30-06:00"})
+    assert night.contains(MONDAY.replace(hour=23))
+    assert night.contains(MONDAY.replace(hour=5, minute=59))
+    assert not night.contains(MONDAY.replace(hour=6))
+    assert night.hours() == [22, 23, 0, 1, 2, 3, 4, 5]
+
+    # Дата в until включается целиком
+    courier = schedules.Window({"key": 3, "from": "2025-07-01", "until": date(2025, 7, 1)})
+    assert courier.contains(datetime(2025, 7, 1, 23, 59))
+    assert not courier.contains(datetime(2025, 7, 2))
+    assert not courier.contains(datetime(2025, 6, 30, 23, 59))
+
+
+def test_window_crossing_midnight_belongs_to_start_day():
+    # Пятница 22:00 - суббота 06:00
+    friday_night = schedules.Window({"key": 4, "weekdays": [5], "time": "22:00-06:00"})
+    assert friday_night.contains(datetime(2025, 7, 4, 23))  # пятница
+    assert friday_night.contains(datetime(2025, 7, 5, 2))  # суббота
+    assert not friday_night.contains(datetime(2025, 7, 4, 2))  # пятница, ночь после четверга
+    assert not friday_night.contains(datetime(2025, 7, 5, 23))
+
+    # Часы после полуночи воскресного окна попадают в понедельник
+    sunday_night = schedules.Window({"key": 5, "weekdays": [7], "time": "23:00-01:30"})
+    assert sunday_night.week_mask() == 1 << (6 * 24 + 23) | 1 << 0 | 1 << 1
+    index = schedules.ScheduleIndex([{"key": 5, "weekdays": [7], "time": "23:00-01:30"}])
+    assert index.allows(5, MONDAY.replace(hour=1, minute=29))
+    assert not index.allows(5, MONDAY.replace(hour=23, minute=30))
+
+
+def test_is_valid():
+    assert schedules.is_valid([{"key": 1, "weekdays": [1], "time": "08:00-09:00"}])
+    assert schedules.is_valid([])
+    assert not schedules.is_valid({"key": 1})
+    assert not schedules.is_valid([{"key": "1"}])
+    assert not schedules.is_valid([{"key": 1, "weekdays": [0]}])
+    assert not schedules.is_valid([{"key": 1, "time": "25:00-26:00"}])
+    assert not schedules.is_valid([{"key": 1, "from": "2025-07-02", "until": "2025-07-01"}])
+    assert not schedules.is_valid([{"key": 1, "from": "2025-07-01T10:00+03:00"}])
+
+
+def test_normalize_yaml_dates():
+    entries = [{"key": 1, "from": date(2025, 7, 1), "until": datetime(2025, 7, 1, 18, 30)}]
+    assert schedules.normalize(entries) == [{"key": 1, "from": "2025-07-01", "until": "2025-07-01 18:30:00"}]
+
+
+@pytest.fixture
+def doorphone(mocker):
+    mocker.patch.object(state, "door_phones", {})
+    mocker.patch.object(state, "key_index", {})
+    mocker.patch.object(state, "apartment_index", {})
+    mocker.patch.object(state, "address_index", {})
+    mocker.patch.object(state, "schedule_index", {})
+    mocker.patch.object(state, "provision_dirty", set())
+    config = {"mac": "mac1", "location": "loc", "allowed_keys": [1], "apartments": [10],
+              "scheduled_keys": [{"key": 555, "weekdays": [1, 2, 3, 4, 5], "time": "07:00-11:00"},
+                                 {"key": 777, "from": "2025-07-01", "until": "2025-07-01"}]}
+    mocker.patch.object(state, "previous_configs", {"mac1": config})
+    state.update_doorphones([config])
+    return config
+
+
+def test_key_allowed_uses_schedule_index(doorphone):
+    assert state.key_allowed("mac1", 1, MONDAY)
+    assert state.key_allowed("mac1", 555, MONDAY.replace(hour=8))
+    assert not state.key_allowed("mac1", 555, MONDAY.replace(hour=12))
+    assert state.key_allowed("mac1", 777, datetime(2025, 7, 1, 12))
+    assert not state.key_allowed("mac1", 777, datetime(2025, 7, 2, 12))
+    assert state.key_index == {1: {"mac1"}, 555: {"mac1"}, 777: {"mac1"}}
+
+    # Индекс перестраивается только при изменении расписания
+    index = state.schedule_index["mac1"]
+    state.update_doorphones([doorphone])
+    assert state.schedule_index["mac1"] is index
+    state.update_doorphones([{**doorphone, "scheduled_keys": []}])
+    assert "mac1" not in state.schedule_index
+    assert state.key_index == {1: {"mac1"}}
+
+
+@pytest.mark.asyncio
+async def test_purge_expired_keys(doorphone, mocker):
+    mocker.patch.object(state, "config_versions", {"mac1": 3})
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("provisioning.Client", return_value=mock_client)
+
+    assert await provisioning.purge_expired_keys(datetime(2025, 7, 1, 12)) == {}
+    mock_client.publish.assert_not_called()
+
+    assert await provisioning.purge_expired_keys(datetime(2025, 7, 2)) == {"mac1": 4}
+    assert state.config_versions["mac1"] == 4
+    assert mock_client.publish.call_args.args == ("intercom/mac1/config/delta",)
+    delta = json.loads(mock_client.publish.call_args.kwargs["payload"])
+    assert delta["version"] == 4
+    assert delta["expired_keys"] == [777]
+    assert delta["expired_windows"] == [doorphone["scheduled_keys"][1]]
+    assert [entry["key"] for entry in state.scheduled_keys("mac1")] == [555]
+    assert state.previous_configs["mac1"]["scheduled_keys"] == [doorphone["scheduled_keys"][0]]
+    assert state.key_index.get(777) is None
+    assert "mac1" in state.provision_dirty
+    assert state.schedule_index["mac1"].next_expiry is None
+
+
+@pytest.mark.asyncio
+async def test_purge_reports_only_keys_without_remaining_access(doorphone, mocker):
+    mocker.patch.object(state, "config_versions", {})
+    mock_client = AsyncMock()
+    mock_client.__aenter__.return_value = mock_client
+    mocker.patch("provisioning.Client", return_value=mock_client)
+    expired = {"key": 5, "until": "2025-07-01"}
+    config = {**doorphone, "scheduled_keys": [expired, {"key": 5}, {"key": 1, "until": "2025-07-01"}]}
+    state.update_doorphones([config])
+
+    await provisioning.purge_expired_keys(datetime(2025, 7, 2))
+
+    delta = json.loads(mock_client.publish.call_args.kwargs["payload"])
+    # У ключа 5 осталось окно на всю неделю, ключ 1 есть в allowed_keys
+    assert delta["expired_keys"] == []
+    assert delta["expired_windows"] == [expired, {"key": 1, "until": "2025-07-01"}]
+    assert state.key_allowed("mac1", 5, datetime(2025, 7, 2))
+
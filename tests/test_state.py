@@ -47,3 +47,34 @@ async def test_call_event(mocker):
     event2 = state.call_event(mac)
     assert event2 is event
 
+
+
+def test_door_transition_compare_and_set(mocker):
+    mocker.patch.object(state, "door_phones", {"mac1": {"door_status": "closed", "door_version": 3}})
+
+    assert state.door_transition("mac1", 2, "closed", "open") is False
+    assert state.door_transition("mac1", 3, "open", "closed") is False
+    assert state.door_transition("mac1", 3, "closed", "open") is True
+    assert state.door_phones["mac1"] == {"door_status": "open", "door_version": 4}
+    assert state.door_transition("unknown", 0, "closed", "open") is False
+
+
+def test_reverse_indexes_follow_config_changes(mocker):
+    mocker.patch.object(state, "door_phones", {})
+    mocker.patch.object(state, "key_index", {})
+    mocker.patch.object(state, "apartment_index", {})
+    mocker.patch.object(state, "address_index", {})
+
+    state.update_doorphones([
+        {"mac": "mac1", "location": "Ул. Пушкина, 1, Подъезд 1", "allowed_keys": [1, 2], "apartments": [1, 2]},
+        {"mac": "mac2", "location": "Ул. Пушкина, 1, Подъезд 2", "allowed_keys": [2], "apartments": [3]},
+    ])
+    assert state.key_index == {1: {"mac1"}, 2: {"mac1", "mac2"}}
+    assert state.address_index == {"ул. пушкина, 1": {"mac1", "mac2"}}
+
+    state.update_doorphones([
+        {"mac": "mac1", "location": "Ул. Ленина, 5, Подъезд 1", "allowed_keys": [2, 3], "apartments": [1]},
+    ])
+    assert state.key_index == {2: {"mac1"}, 3: {"mac1"}}
+    assert state.apartment_index == {1: {"mac1"}}
+    assert state.address_index == {"ул. ленина, 5": {"mac1"}}
@@ -0,0 +1,63 @@
+import gzip
+
+from fastapi.testclient import TestClient
+
+import static_assets
+from main import app
+
+client = TestClient(app)
+
+
+def test_fingerprinted_asset_is_immutable_and_compressed():
+    asset_url = static_assets.url("main.css")
+    assert asset_url.startswith("/static/main.") and asset_url.endswith(".css")
+
+    response = client.get(asset_url, headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == static_assets.IMMUTABLE
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    with open("static/main.css", "rb") as f:
+        assert response.content == f.read()
+
+    etag = response.headers["etag"]
+    cached = client.get(asset_url, headers={"Accept-Encoding": "gzip", "If-None-Match": f'"other", W/{etag}'})
+    assert cached.status_code == 304
+    assert "content-encoding" not in cached.headers
+    assert cached.headers["etag"] == etag
+
+    # Подстрока чужого ETag не считается совпадением
+    partial = client.get(asset_url, headers={"Accept-Encoding": "gzip", "If-None-Match": f'"x{etag[1:]}'})
+    assert partial.status_code == 200
+
+
+def test_asset_rejects_other_methods():
+    assert client.post(static_assets.url("main.css")).status_code == 405
+    assert client.head(static_assets.url("main.css")).status_code == 200
+
+
+def test_plain_asset_url_revalidates_and_negotiates():
+    response = client.get("/static/main.css", headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == static_assets.REVALIDATE
+    assert "content-encoding" not in response.headers
+
+    # Картинки не пережимаются
+    response = client.get(static_assets.url("door_phone.png"), headers={"Accept-Encoding": "gzip, br"})
+    assert "content-encoding" not in response.headers
+
+
+def test_asset_choose_encoding():
+    asset = static_assets.Asset(b"body { color: red; }" * 50, "text/css", "abc")
+    assert asset.choose("gzip;q=0, deflate") == "identity"
+    assert asset.choose("gzip, deflate") == "gzip"
+    assert gzip.decompress(asset.variants["gzip"]) == b"body { color: red; }" * 50
+    if static_assets.brotli is not None:
+        assert asset.choose("gzip, br") == "br"
+
+
+def test_templates_use_fingerprinted_urls(mocker):
+    mocker.patch("main.state.door_phones", {"AA:BB:CC:DD:EE:FF": {"door_status": "closed"}})
+    response = client.get("/AA:BB:CC:DD:EE:FF")
+    assert static_assets.url("main.css") in response.text
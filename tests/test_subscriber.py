@@ -0,0 +1,67 @@
+import pytest
+
+from aiomqtt import ProtocolVersion
+
+import settings
+import subscriber
+
+
+def test_client_options_persistent_session(mocker):
+    mocker.patch.object(settings, "MQTT_CLIENT_ID", "intercom-a")
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 4)
+    assert subscriber.client_options() == {"identifier": "intercom-a", "clean_session": False}
+
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 5)
+    mocker.patch.object(settings, "MQTT_SESSION_EXPIRY", 600)
+    options = subscriber.client_options()
+    assert options["protocol"] == ProtocolVersion.V5
+    assert options["identifier"] == "intercom-a"
+    assert options["clean_start"] is False
+    assert options["properties"].SessionExpiryInterval == 600
+
+
+def test_client_id_defaults_to_hostname(mocker):
+    mocker.patch.object(settings, "MQTT_CLIENT_ID", "")
+    mocker.patch("subscriber.socket.gethostname", return_value="node1")
+    assert subscriber.client_id() == "intercom-service-node1"
+
+
+def test_warns_without_configured_client_id(mocker):
+    mock_logger = mocker.patch("subscriber.logger")
+    mocker.patch.object(settings, "MQTT_CLIENT_ID", "intercom-a")
+    subscriber.warn_if_default_id()
+    mock_logger.warning.assert_not_called()
+
+    mocker.patch.object(settings, "MQTT_CLIENT_ID", "")
+    subscriber.warn_if_default_id()
+    mock_logger.warning.assert_called_once()
+
+
+def test_backoff_grows_with_jitter_and_resets(mocker):
+    mocker.patch("subscriber.random.uniform", side_effect=lambda low, high: high)
+    backoff = subscriber.Backoff(base=0.5, max_delay=3)
+
+    assert [backoff.next_delay() for _ in range(5)] == [0.5, 1, 2, 3, 3]
+    backoff.reset()
+    assert backoff.next_delay() == 0.5
+
+
+def test_connection_stats_track_downtime(mocker):
+    now = [100.0]
+    mocker.patch("subscriber.time.monotonic", side_effect=lambda: now[0])
+    stats = subscriber.ConnectionStats()
+
+    stats.connected()
+    stats.disconnected(Exception("broker gone"))
+    now[0] += 4
+    assert stats.snapshot()["downtime_current"] == 4
+    stats.disconnected()
+    now[0] += 2
+    stats.connected()
+
+    snapshot = stats.snapshot()
+    assert snapshot["connected"] is True
+    assert snapshot["reconnects"] == 1
+    assert snapshot["downtime_last"] == 6
+    assert snapshot["downtime_total"] == 6
+    assert snapshot["last_error"] == "broker gone"
@@ -0,0 +1,90 @@
+import pytest
+import asyncio
+from unittest.mock import AsyncMock
+
+from pydantic import BaseModel
+
+import commands
+import settings
+import topic_router
+
+
+@pytest.fixture(autouse=True)
+def fresh_commands(mocker):
+    mocker.patch.object(commands, "dedup", commands.DedupCache(100, 60))
+    mocker.patch.object(commands, "latency", {"handling": {}, "e2e": {}})
+    mocker.patch.object(commands, "_in_flight", {})
+    mocker.patch.object(settings, "MQTT_PROTOCOL", 4)
+
+
+def test_match_prefers_exact_segments_and_captures_params():
+    router = topic_router.TopicRouter()
+    router.add("intercom/{mac}/management/close", AsyncMock(), name="close")
+    router.add("intercom/{mac}/management/config/refresh", AsyncMock(), name="refresh")
+    router.add("intercom/{mac}/management/#", AsyncMock(), name="open")
+    router.add("devices/+/life", AsyncMock(), name="life")
+
+    route, params = router.match("intercom/mac1/management/close")
+    assert (route.name, params) == ("close", {"mac": "mac1"})
+    route, params = router.match("intercom/mac2/management/config/refresh")
+    assert (route.name, params) == ("refresh", {"mac": "mac2"})
+    route, params = router.match("intercom/mac3/management/door")
+    assert (route.name, params) == ("open", {"mac": "mac3"})
+    route, params = router.match("devices/mac4/life")
+    assert (route.name, params) == ("life", {})
+    assert router.match("intercom/mac1/config") is None
+
+
+def test_add_rejects_invalid_patterns():
+    router = topic_router.TopicRouter()
+    router.add("intercom/{mac}/status", AsyncMock())
+
+    with pytest.raises(ValueError):
+        router.add("intercom/#/status", AsyncMock())
+    with pytest.raises(ValueError):
+        router.add("intercom/{id}/close", AsyncMock())
+
+
+@pytest.mark.asyncio
+async def test_dispatch_validates_schema_per_handler():
+    class CloseCommand(BaseModel):
+        reason: str
+
+    router = topic_router.TopicRouter()
+    handler = AsyncMock(return_value={"door_status": "closed"})
+    router.add("intercom/{mac}/management/close", handler, name="close", schema=CloseCommand)
+    client = AsyncMock()
+
+    ok = await router.dispatch(client, "intercom/mac1/management/close", {"reason": "fire"})
+    bad = await router.dispatch(client, "intercom/mac1/management/close", {"reason": 1})
+
+    assert ok["status"] == "ok"
+    assert ok["result"] == {"door_status": "closed"}
+    handler.assert_awaited_once_with(client, CloseCommand(reason="fire"), mac="mac1")
+    assert bad["status"] == "error"
+    assert await router.dispatch(client, "other/topic", {}) is None
+
+
+@pytest.mark.asyncio
+async def test_dispatch_respects_concurrency_limit():
+    router = topic_router.TopicRouter()
+    running = 0
+    peak = 0
+    release = asyncio.Event()
+
+    async def handler(client, payload, mac):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await release.wait()
+        running -= 1
+
+    router.add("intercom/{mac}/management/status", handler, name="status", concurrency=2)
+    tasks = [asyncio.create_task(router.dispatch(AsyncMock(), f"intercom/mac{i}/management/status", {}))
+             for i in range(5)]
+    for _ in range(3):
+        await asyncio.sleep(0)
+    assert peak == 2
+    release.set()
+    await asyncio.gather(*tasks)
+    assert peak == 2
@@ -0,0 +1,110 @@
+# topic_router.py
+
+# Маршрутизация входящих MQTT-команд. Фильтры топиков с параметрами вида
+# intercom/{mac}/management/close компилируются в префиксное дерево, сообщение
+# разбирается за один проход по сегментам топика. У каждого обработчика своя
+# схема payload (pydantic-модель) и свой лимит одновременных вызовов.
+
+import asyncio
+import logging
+
+import commands
+
+logger = logging.getLogger(__name__)
+
+
+class Route:
+    def __init__(self, name: str, pattern: str, handler, schema=None, concurrency: int = 0):
+        self.name = name
+        self.pattern = pattern
+        self.handler = handler
+        self.schema = schema
+        self.semaphore = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+
+    async def call(self, client, payload, params: dict):
+        data = self.schema.model_validate(payload) if self.schema is not None else payload
+        if self.semaphore is None:
+            return await self.handler(client, data, **params)
+        async with self.semaphore:
+            return await self.handler(client, data, **params)
+
+
+class Node:
+    __slots__ = ("children", "param", "param_node", "rest", "route")
+
+    def __init__(self):
+        self.children = {}     # точный сегмент -> Node
+        self.param = None      # имя параметра для {name} или + (None - без захвата)
+        self.param_node = None
+        self.rest = None       # маршрут для # - оставшиеся уровни топика
+        self.route = None
+
+
+class TopicRouter:
+    def __init__(self):
+        self.root = Node()
+        self.routes = []
+
+    def add(self, pattern: str, handler, name: str | None = None, schema=None, concurrency: int = 0) -> Route:
+        route = Route(name or pattern, pattern, handler, schema, concurrency)
+        segments = pattern.split("/")
+        node = self.root
+        for i, segment in enumerate(segments):
+            if segment == "#":
+                if i != len(segments) - 1:
+                    raise ValueError(f"# допускается только в конце фильтра: {pattern}")
+                node.rest = route
+                break
+            if segment == "+" or segment.startswith("{") and segment.endswith("}"):
+                param = segment[1:-1] if segment != "+" else None
+                if node.param_node is None:
+                    node.param_node = Node()
+                    node.param = param
+                elif node.param != param:
+                    raise ValueError(f"Конфликт имён параметров на уровне {i} в {pattern}")
+                node = node.param_node
+            else:
+                node = node.children.setdefault(segment, Node())
+        else:
+            node.route = route
+        self.routes.append(route)
+        return route
+
+    def route(self, pattern: str, name: str | None = None, schema=None, concurrency: int = 0):
+        def decorator(handler):
+            self.add(pattern, handler, name, schema, concurrency)
+            return handler
+        return decorator
+
+    def match(self, topic: str) -> tuple[Route, dict] | None:
+        return self._match(self.root, topic.split("/"), 0, {})
+
+    def _match(self, node: Node, parts: list[str], i: int, params: dict):
+        # Приоритет: точный сегмент, затем параметр, затем #
+        if i == len(parts):
+            if node.route is not None:
+                return node.route, params
+        else:
+            child = node.children.get(parts[i])
+            if child is not None:
+                found = self._match(child, parts, i + 1, params)
+                if found is not None:
+                    return found
+            if node.param_node is not None:
+                captured = {**params, node.param: parts[i]} if node.param else params
+                found = self._match(node.param_node, parts, i + 1, captured)
+                if found is not None:
+                    return found
+        if node.rest is not None:
+            return node.rest, params
+        return None
+
+    async def dispatch(self, client, topic: str, payload, properties=None):
+        found = self.match(topic)
+        if found is None:
+            logger.warning(f"Нет обработчика для топика {topic}")
+            return None
+        route, params = found
+        return await commands.execute(client, params.get("mac", ""), route.name,
+                                      payload if isinstance(payload, dict) else {},
+                                      lambda: route.call(client, payload, params), properties)